@@ -23,56 +23,77 @@ original codebase:
 
 ## Usage
 See the example in `BatchClassifier`.
+
+scikit-learn and tqdm are only imported once they are needed (i.e. when fitting), such that
+importing this module is cheap. `DEFAULT_CLASSIFIERS` and `TRANSFORMERS` are still available as
+module attributes, and are created on first access.
 """
 
 import time
+from functools import cache
 from pprint import pprint
+from typing import TYPE_CHECKING
 
 import numpy as np
 import pandas as pd
 from numpy.typing import NDArray
-from sklearn.compose import ColumnTransformer
-from sklearn.dummy import DummyClassifier
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.impute import SimpleImputer
-from sklearn.linear_model import LogisticRegression
-from sklearn.metrics import (
-    accuracy_score,
-    balanced_accuracy_score,
-    f1_score,
-)
-from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import OneHotEncoder, OrdinalEncoder, StandardScaler
-from tqdm import tqdm
+
+if TYPE_CHECKING:
+    from sklearn.base import BaseEstimator
 
 FloatArray = NDArray[np.float64]
 
-DEFAULT_CLASSIFIERS = [
-    LogisticRegression,
-    RandomForestClassifier,
-    DummyClassifier,
-]
-
-TRANSFORMERS = {
-    "numeric": Pipeline(
-        steps=[
-            ("imputer", SimpleImputer(strategy="mean")),
-            ("scaler", StandardScaler()),
-        ]
-    ),
-    "categorical_low": Pipeline(
-        steps=[
-            ("imputer", SimpleImputer(strategy="constant", fill_value="missing")),
-            ("encoding", OneHotEncoder(handle_unknown="ignore", sparse_output=False)),
-        ]
-    ),
-    "categorical_high": Pipeline(
-        steps=[
-            ("imputer", SimpleImputer(strategy="constant", fill_value="missing")),
-            ("encoding", OrdinalEncoder()),
-        ]
-    ),
-}
+
+@cache
+def get_default_classifiers() -> list[type]:
+    """Classifiers to run when none are provided to `BatchClassifier`."""
+    from sklearn.dummy import DummyClassifier
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.linear_model import LogisticRegression
+
+    return [
+        LogisticRegression,
+        RandomForestClassifier,
+        DummyClassifier,
+    ]
+
+
+@cache
+def get_transformers() -> dict[str, "BaseEstimator"]:
+    """Preprocessing pipelines of the numeric and (low/high cardinality) categorical features."""
+    from sklearn.impute import SimpleImputer
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import OneHotEncoder, OrdinalEncoder, StandardScaler
+
+    return {
+        "numeric": Pipeline(
+            steps=[
+                ("imputer", SimpleImputer(strategy="mean")),
+                ("scaler", StandardScaler()),
+            ]
+        ),
+        "categorical_low": Pipeline(
+            steps=[
+                ("imputer", SimpleImputer(strategy="constant", fill_value="missing")),
+                ("encoding", OneHotEncoder(handle_unknown="ignore", sparse_output=False)),
+            ]
+        ),
+        "categorical_high": Pipeline(
+            steps=[
+                ("imputer", SimpleImputer(strategy="constant", fill_value="missing")),
+                ("encoding", OrdinalEncoder()),
+            ]
+        ),
+    }
+
+
+def __getattr__(name: str):
+    # Lazily create the module constants that depend on scikit-learn
+    if name == "DEFAULT_CLASSIFIERS":
+        return get_default_classifiers()
+    if name == "TRANSFORMERS":
+        return get_transformers()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def get_cardinality_split(
@@ -113,6 +134,10 @@ class BatchClassifier:
             number for verbosity.
         prediction : bool, optional (default=False)
             When set to True, the predictions of all the models models are returned as dataframe.
+        feature_reducer : estimator, optional (default=None)
+            When provided, e.g. by `analysis.feature_reduction.get_feature_reducer`, reduces the
+            (numeric) features ahead of each classifier, which speeds up training on full
+            resolution spectra. The fitted pipelines are kept in `models`.
 
     Examples:
         >>> from sklearn.datasets import load_breast_cancer
@@ -147,15 +172,17 @@ class BatchClassifier:
         return_predictions: bool = False,
         verbose: bool = False,
         random_state: int = 42,
+        feature_reducer: "None | BaseEstimator" = None,
     ):
         self.classifiers = classifiers
         self.return_predictions = return_predictions
         self.verbose = verbose
         self.random_state = random_state
+        self.feature_reducer = feature_reducer
 
         # Fall back to default classifiers if none are provided
         if self.classifiers is None:
-            self.classifiers = DEFAULT_CLASSIFIERS
+            self.classifiers = get_default_classifiers()
 
         self.models = {}
 
@@ -178,6 +205,12 @@ class BatchClassifier:
             predictions:
                 Predictions from each classifier as a pandas DataFrame.
         """
+        from sklearn.base import clone
+        from sklearn.compose import ColumnTransformer
+        from sklearn.metrics import accuracy_score, balanced_accuracy_score, f1_score
+        from sklearn.pipeline import Pipeline
+        from tqdm import tqdm
+
         # Convert training and testing data from numpy arrays to pandas DataFrames to
         # more easily determine the data type of each feature
         X_train = pd.DataFrame(X_train)
@@ -191,13 +224,25 @@ class BatchClassifier:
 
         # Define feature transformers
         # https://scikit-learn.org/stable/modules/compose.html#column-transformer
+        transformers = get_transformers()
         preprocessor = ColumnTransformer(
             transformers=[
-                ("numeric", TRANSFORMERS["numeric"], numeric_features),
-                ("categorical_low", TRANSFORMERS["categorical_low"], low_cardinality_columns),
-                ("categorical_high", TRANSFORMERS["categorical_high"], high_cardinality_columns),
+                ("numeric", transformers["numeric"], numeric_features),
+                ("categorical_low", transformers["categorical_low"], low_cardinality_columns),
+                ("categorical_high", transformers["categorical_high"], high_cardinality_columns),
             ]
         )
+        # Feature reduction only applies to numeric features (i.e. spectra), after which the
+        # reduced features are treated as numeric features
+        if self.feature_reducer is not None:
+            if len(categorical_features) > 0:
+                raise ValueError("Feature reduction requires all features to be numeric.")
+            preprocessor = Pipeline(
+                steps=[
+                    ("reducer", self.feature_reducer),
+                    ("numeric", transformers["numeric"]),
+                ]
+            )
 
         # Performance metrics to record
         results = {
@@ -219,14 +264,14 @@ class BatchClassifier:
             if "random_state" in model().get_params().keys():
                 pipeline = Pipeline(
                     steps=[
-                        ("preprocessor", preprocessor),
+                        ("preprocessor", clone(preprocessor)),
                         ("classifier", model(random_state=self.random_state)),
                     ]
                 )
             else:
                 pipeline = Pipeline(
                     steps=[
-                        ("preprocessor", preprocessor),
+                        ("preprocessor", clone(preprocessor)),
                         ("classifier", model()),
                     ]
                 )
@@ -246,8 +291,9 @@ class BatchClassifier:
             results["balanced_accuracy"].append(balanced_accuracy)
             results["f1_score"].append(f1_result)
             results["run_time_s"].append(run_time_s)
-            # Record predictions
+            # Record predictions and fitted pipeline
             predictions[model_name] = y_pred
+            self.models[model_name] = pipeline
 
             if self.verbose:
                 out = {
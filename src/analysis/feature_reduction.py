@@ -0,0 +1,190 @@
+"""
+# Spectral feature reduction
+
+Full-resolution spectra have thousands of mostly redundant features (neighboring wavenumbers are
+strongly correlated), which makes training classifiers slower without making them better. This
+module reduces spectra to a handful of features before classification, either by integrating the
+intensity over wavenumber bands, or by projecting onto principal components or random
+directions.
+
+Band integrals of all spectra are computed in one vectorized pass: the cumulative (trapezoidal)
+integral of the whole matrix is computed once, after which the integral over any band is the
+difference of the cumulative integral at the edges of the band.
+
+## Usage
+>>> from analysis.classification import BatchClassifier
+>>> from analysis.feature_reduction import get_feature_reducer
+>>> from analysis.resampling import resample_spectra
+>>> wavenumbers_cm1 = np.arange(400, 1800, 1.0)
+>>> X = resample_spectra(spectra, wavenumbers_cm1)
+>>> reducer = get_feature_reducer("bands", wavenumbers_cm1=wavenumbers_cm1)
+>>> batch_classifier = BatchClassifier(feature_reducer=reducer)
+>>> scores = batch_classifier.fit(X_train, X_test, y_train, y_test)
+"""
+
+import numpy as np
+from numpy.typing import NDArray
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.decomposition import PCA
+from sklearn.random_projection import GaussianRandomProjection
+from sklearn.utils.validation import check_is_fitted
+
+from .resampling import get_interpolation_weights
+
+FloatArray = NDArray[np.float64]
+
+# Raman bands of biological relevance to Chlamydomonas cells as (lower, upper) bounds in cm⁻¹
+RAMAN_BANDS = {
+    "starch_480": (465, 495),
+    "chlorophyll_744": (735, 755),
+    "starch_940": (925, 955),
+    "carotenoid_1008": (995, 1020),
+    "carotenoid_1157": (1145, 1170),
+    "chlorophyll_1187": (1175, 1200),
+    "chlorophyll_1326": (1310, 1340),
+    "lipid_1440": (1425, 1460),
+    "carotenoid_1525": (1505, 1545),
+    "lipid_protein_1660": (1640, 1680),
+    "lipid_2850": (2835, 2865),
+    "lipid_protein_2930": (2900, 2960),
+}
+
+
+class BandIntegrator(TransformerMixin, BaseEstimator):
+    """Reduce spectra to the integrated intensity over wavenumber bands.
+
+    Attributes:
+        wavenumbers_cm1 : array-like
+            Wavenumber axis of the columns of the feature matrix.
+        bands : dict[str, tuple[float, float]] | None (default=None)
+            Bands as (lower, upper) bounds in cm⁻¹, keyed by name. Defaults to `RAMAN_BANDS` if
+            `bin_width` is not provided either.
+        bin_width : float | None (default=None)
+            Width of uniform bins spanning the wavenumber axis, used instead of `bands`.
+        normalize : bool (default=False)
+            Divide the integral of each band by the width of the band, i.e. return the average
+            intensity over each band.
+
+    Examples:
+        >>> wavenumbers_cm1 = np.arange(400, 1800, 1.0)
+        >>> X = resample_spectra(spectra, wavenumbers_cm1)
+        >>> BandIntegrator(wavenumbers_cm1, bin_width=20).fit_transform(X).shape
+        (num_spectra, 70)
+    """
+
+    def __init__(
+        self,
+        wavenumbers_cm1: FloatArray,
+        bands: dict[str, tuple[float, float]] | None = None,
+        bin_width: float | None = None,
+        normalize: bool = False,
+    ):
+        self.wavenumbers_cm1 = wavenumbers_cm1
+        self.bands = bands
+        self.bin_width = bin_width
+        self.normalize = normalize
+
+    def fit(self, X: FloatArray, y: FloatArray | None = None) -> "BandIntegrator":
+        """Determine the bands that lie within the wavenumber axis."""
+        wavenumbers_cm1 = np.asarray(self.wavenumbers_cm1, dtype=float)
+        if np.shape(X)[1] != wavenumbers_cm1.size:
+            raise ValueError(
+                f"X has {np.shape(X)[1]} features, but `wavenumbers_cm1` has "
+                f"{wavenumbers_cm1.size} values."
+            )
+        self.n_features_in_ = wavenumbers_cm1.size
+        self.order_ = np.argsort(wavenumbers_cm1)
+        self.sorted_wavenumbers_cm1_ = wavenumbers_cm1[self.order_]
+        wavenumber_min = self.sorted_wavenumbers_cm1_[0]
+        wavenumber_max = self.sorted_wavenumbers_cm1_[-1]
+
+        if self.bin_width is not None:
+            edges = np.arange(wavenumber_min, wavenumber_max + self.bin_width, self.bin_width)
+            edges = np.clip(edges, wavenumber_min, wavenumber_max)
+            bands = {
+                f"{lower:.0f}-{upper:.0f}": (lower, upper)
+                for lower, upper in zip(edges[:-1], edges[1:], strict=True)
+                if upper > lower
+            }
+        else:
+            bands = RAMAN_BANDS if self.bands is None else self.bands
+            # Only keep bands that lie (at least partly) within the wavenumber axis
+            bands = {
+                name: (max(lower, wavenumber_min), min(upper, wavenumber_max))
+                for name, (lower, upper) in bands.items()
+                if upper > wavenumber_min and lower < wavenumber_max
+            }
+        if not bands:
+            raise ValueError("None of the bands lie within the wavenumber axis.")
+
+        self.band_names_ = np.array(list(bands.keys()), dtype=object)
+        self.band_edges_ = np.array(list(bands.values()), dtype=float)
+        return self
+
+    def transform(self, X: FloatArray) -> FloatArray:
+        """Integrate the intensity of each spectrum (row of `X`) over each band."""
+        check_is_fitted(self, "band_edges_")
+        X = np.asarray(X, dtype=float)[:, self.order_]
+        wavenumbers_cm1 = self.sorted_wavenumbers_cm1_
+
+        # Cumulative trapezoidal integral along the wavenumber axis
+        areas = 0.5 * (X[:, 1:] + X[:, :-1]) * np.diff(wavenumbers_cm1)
+        cumulative = np.zeros_like(X)
+        np.cumsum(areas, axis=1, out=cumulative[:, 1:])
+
+        # Integrals over bands as differences of the cumulative integral at the band edges
+        columns, weights = get_interpolation_weights(self.band_edges_.ravel(), wavenumbers_cm1)
+        at_edges = (1 - weights) * cumulative[:, columns - 1] + weights * cumulative[:, columns]
+        at_edges = at_edges.reshape(X.shape[0], -1, 2)
+        integrals = at_edges[:, :, 1] - at_edges[:, :, 0]
+        if self.normalize:
+            integrals /= np.diff(self.band_edges_, axis=1).ravel()
+        return integrals
+
+    def get_feature_names_out(self, input_features=None) -> NDArray[np.object_]:
+        check_is_fitted(self, "band_names_")
+        return self.band_names_.copy()
+
+
+def get_feature_reducer(
+    method: str = "bands",
+    wavenumbers_cm1: FloatArray | None = None,
+    bands: dict[str, tuple[float, float]] | None = None,
+    bin_width: float = 20,
+    num_components: int = 20,
+    random_state: int = 42,
+) -> BaseEstimator:
+    """Get a feature reducer to pass to `BatchClassifier`.
+
+    Args:
+        method:
+            One of
+            - "bands": integrate over biologically meaningful Raman bands (see `RAMAN_BANDS`),
+            - "uniform": integrate over uniform bins of width `bin_width`,
+            - "pca": project onto the first `num_components` principal components,
+            - "random_projection": project onto `num_components` Gaussian random directions.
+        wavenumbers_cm1:
+            Wavenumber axis of the feature matrix (required for "bands" and "uniform").
+        bands:
+            Bands to integrate over for "bands", defaults to `RAMAN_BANDS`.
+        bin_width:
+            Width of the bins in cm⁻¹ for "uniform".
+        num_components:
+            Number of components for "pca" and "random_projection".
+        random_state:
+            Random state for "pca" and "random_projection".
+    """
+    if method in ("bands", "uniform"):
+        if wavenumbers_cm1 is None:
+            raise ValueError(f"`wavenumbers_cm1` is required for method '{method}'.")
+        if method == "bands":
+            return BandIntegrator(wavenumbers_cm1, bands=bands)
+        return BandIntegrator(wavenumbers_cm1, bin_width=bin_width)
+    if method == "pca":
+        return PCA(n_components=num_components, random_state=random_state)
+    if method == "random_projection":
+        return GaussianRandomProjection(n_components=num_components, random_state=random_state)
+    raise ValueError(
+        f"Unknown method '{method}', expected one of 'bands', 'uniform', 'pca', "
+        "'random_projection'."
+    )
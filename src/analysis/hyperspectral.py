@@ -0,0 +1,648 @@
+"""
+# Hyperspectral maps
+
+Renishaw multipoint scans record a spectrum at each of many (x, y) stage positions. This module
+arranges such scans into a `RamanMap`: a `(x, y, wavenumber)` cube of intensities that lives in a
+memory-mapped `.npy` file, along with the positions and wavenumbers. The cube is written while the
+txt file is parsed in chunks, and is processed tile by tile afterwards (optionally by several
+worker processes that each open the memory-mapped file themselves), such that maps of whole plates
+can be analysed without ever holding the cube in memory.
+
+Positions of raster scans are snapped to a regular grid, with a separate step along x and y;
+pixels of the grid at which no spectrum was recorded are left as NaN and are skipped during
+processing. Scans of scattered points that do not fit a grid (e.g. the `*_cells*.txt` files, in
+which cells were picked by hand) are kept as a `(point, wavenumber)` array instead, rather than
+as a mostly empty cube.
+
+## Usage
+>>> from analysis.hyperspectral import RamanMap
+>>> raman_map = RamanMap.from_renishaw_txtfile("plate_map.txt", "cache/plate_map")
+>>> raman_map = RamanMap.open("cache/plate_map")  # later on, without parsing the txt file again
+>>> corrected_map = raman_map.preprocess(subtract_baseline, "cache/plate_map_corrected")
+>>> labels_image = corrected_map.predict_image("model.joblib", num_workers=4)
+
+Check that jittered raster scans are still snapped onto their grid with
+
+    python -m analysis.hyperspectral
+"""
+
+import argparse
+import io
+import json
+import os
+import tempfile
+from collections.abc import Callable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from numpy.typing import NDArray
+
+from .readers import check_point_lengths, find_point_starts
+from .resampling import resample_matrix
+
+FloatArray = NDArray[np.float64]
+# Slices of the spatial axes of the cube, i.e. (x, y) for grids and (point,) for scattered points
+Tile = tuple[slice, ...]
+
+# Maximum distance of positions from the grid (in pixels), and minimum fraction of pixels of the
+# grid with a spectrum, for a scan to be considered a raster scan
+GRID_TOLERANCE = 0.25
+GRID_MIN_FILL_FRACTION = 0.5
+# Gaps between sorted positions, relative to the largest gap, below which positions are taken to
+# be in the same row (or column) of a raster scan
+ROW_GAP_FRACTION = 0.1
+
+# Names of the files of a `RamanMap` within its directory
+MAP_FILENAMES = {
+    "cube": "cube.npy",
+    "wavenumbers_cm1": "wavenumbers_cm1.npy",
+    "positions": "positions.npy",
+    "mask": "mask.npy",
+    "info": "info.json",
+}
+
+# State of each worker process, set once by `_init_worker` rather than sent along with each tile
+_worker_state = {}
+
+
+def _iter_multipoint_chunks(
+    source: str | Path | bytes,
+    chunk_size: int,
+) -> Iterator[FloatArray]:
+    """Iterate over the (x, y, wavenumber, intensity) rows of a Renishaw multipoint txt file in
+    chunks of `chunk_size` rows."""
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    reader = pd.read_csv(
+        source,
+        sep="\t",
+        header=None,
+        skiprows=1,
+        usecols=range(4),
+        dtype=np.float64,
+        engine="c",
+        chunksize=chunk_size,
+    )
+    with reader:
+        for chunk in reader:
+            yield chunk.to_numpy()
+
+
+def _scan_multipoint_file(
+    source: str | Path | bytes,
+    chunk_size: int,
+) -> tuple[FloatArray, FloatArray]:
+    """Find the position of each point and the shared wavenumbers of a multipoint scan, without
+    keeping the intensities in memory."""
+    positions = []
+    starts = []
+    num_rows = 0
+    first_wavenumber = None
+    previous_position = None
+    for values in _iter_multipoint_chunks(source, chunk_size):
+        if first_wavenumber is None:
+            first_wavenumber = values[0, 2]
+        chunk_starts = np.flatnonzero(
+            find_point_starts(values, first_wavenumber, previous_position)
+        )
+        positions.append(values[chunk_starts, :2])
+        starts.append(num_rows + chunk_starts)
+        previous_position = values[-1, :2]
+        num_rows += values.shape[0]
+
+    positions = np.concatenate(positions)
+    num_wavenumbers = check_point_lengths(np.concatenate(starts), num_rows)
+    wavenumbers_cm1 = next(_iter_multipoint_chunks(source, num_wavenumbers))[:, 2]
+    return positions, wavenumbers_cm1
+
+
+def _get_step(values: FloatArray) -> float:
+    """Step between the rows (or columns) of a raster scan, or 1 if all values are the same.
+
+    The values are first clustered into rows, splitting them wherever the gap between sorted
+    values exceeds `ROW_GAP_FRACTION` times the largest gap, which absorbs the jitter of the stage
+    readout within a row. The step is the median distance between the centres of adjacent rows,
+    such that neither jitter nor the odd missing row skews it.
+    """
+    values = np.sort(values)
+    gaps = np.diff(values)
+    if not gaps.size or gaps.max() == 0:
+        return 1.0
+    rows = np.split(values, np.flatnonzero(gaps > ROW_GAP_FRACTION * gaps.max()) + 1)
+    centres = np.array([row.mean() for row in rows])
+    return float(np.median(np.diff(centres))) if centres.size > 1 else 1.0
+
+
+def get_grid_indices(
+    positions: FloatArray,
+    pixel_size: float | tuple[float, float] | None = None,
+) -> tuple[NDArray[np.intp], FloatArray, FloatArray]:
+    """Snap (x, y) positions to a regular grid.
+
+    Args:
+        positions:
+            (x, y) positions of shape (num_points, 2).
+        pixel_size:
+            Spacing of the grid as (dx, dy), or a single spacing for both axes, in the units of
+            the positions (µm). Estimated from the positions along each axis if not provided
+            (see `_get_step`).
+
+    Returns:
+        indices:
+            (x, y) grid indices of each position, of shape (num_points, 2).
+        x_um:
+            x position of each column of the grid.
+        y_um:
+            y position of each row of the grid.
+    """
+    positions = np.asarray(positions, dtype=float)
+    origin = positions.min(axis=0)
+    if pixel_size is None:
+        pixel_size = np.array([_get_step(positions[:, axis]) for axis in range(2)])
+        # Fit the origin and step of each axis to the initial indices, as the origin is off by
+        # the jitter of the stage readout, and any error in the step adds up over many rows
+        indices = np.rint((positions - origin) / pixel_size)
+        for axis in range(2):
+            if np.ptp(indices[:, axis]) > 0:
+                pixel_size[axis], origin[axis] = np.polyfit(
+                    indices[:, axis], positions[:, axis], deg=1
+                )
+    pixel_size = np.broadcast_to(np.asarray(pixel_size, dtype=float), (2,))
+    indices = np.rint((positions - origin) / pixel_size).astype(np.intp)
+    shape = indices.max(axis=0) + 1
+    x_um = origin[0] + pixel_size[0] * np.arange(shape[0])
+    y_um = origin[1] + pixel_size[1] * np.arange(shape[1])
+    return indices, x_um, y_um
+
+
+def is_grid_scan(
+    positions: FloatArray,
+    pixel_size: float | tuple[float, float] | None = None,
+) -> bool:
+    """Whether the positions of a scan lie on a regular grid that they mostly fill (see
+    `GRID_TOLERANCE` and `GRID_MIN_FILL_FRACTION`), as for raster scans."""
+    positions = np.asarray(positions, dtype=float)
+    indices, x_um, y_um = get_grid_indices(positions, pixel_size)
+    if np.unique(indices, axis=0).shape[0] < indices.shape[0]:
+        return False
+    steps = np.array(
+        [x_um[1] - x_um[0] if x_um.size > 1 else 1.0, y_um[1] - y_um[0] if y_um.size > 1 else 1.0]
+    )
+    snapped = np.column_stack([x_um[indices[:, 0]], y_um[indices[:, 1]]])
+    on_grid = np.all(np.abs(positions - snapped) / steps <= GRID_TOLERANCE)
+    fill_fraction = positions.shape[0] / (x_um.size * y_um.size)
+    return bool(on_grid and fill_fraction >= GRID_MIN_FILL_FRACTION)
+
+
+def _init_worker(cube_filepath: Path, function: Callable, output_filepath: Path | None):
+    _worker_state["cube"] = np.load(cube_filepath, mmap_mode="r")
+    _worker_state["function"] = function
+    if output_filepath is not None:
+        _worker_state["output"] = np.load(output_filepath, mmap_mode="r+")
+
+
+def _process_tile(tile: Tile) -> tuple[Tile, NDArray[np.bool_], np.ndarray | None]:
+    """Apply the function of the worker to the measured pixels of a tile of the cube.
+
+    If the worker has an output cube, the result is written straight into it and not returned.
+    """
+    intensities = np.asarray(_worker_state["cube"][tile], dtype=np.float64)
+    measured = np.isfinite(intensities).all(axis=-1)
+    if not measured.any():
+        return tile, measured, None
+
+    result = np.asarray(_worker_state["function"](intensities[measured]))
+    if "output" not in _worker_state:
+        return tile, measured, result
+
+    output_tile = np.full(
+        (*measured.shape, result.shape[1]), np.nan, dtype=_worker_state["output"].dtype
+    )
+    output_tile[measured] = result
+    _worker_state["output"][tile] = output_tile
+    return tile, measured, None
+
+
+class PipelinePredictor:
+    """Picklable function that resamples spectra onto the wavenumbers of a fitted pipeline and
+    predicts their classes, for use with `RamanMap.map_tiles`.
+
+    Attributes:
+        pipeline : estimator
+            Fitted pipeline (or classifier) with a `predict` method.
+        wavenumbers_cm1 : array-like
+            Wavenumbers of the spectra to predict.
+        model_wavenumbers_cm1 : array-like
+            Wavenumbers onto which spectra were resampled to train the pipeline.
+    """
+
+    def __init__(self, pipeline, wavenumbers_cm1: FloatArray, model_wavenumbers_cm1: FloatArray):
+        self.pipeline = pipeline
+        self.wavenumbers_cm1 = wavenumbers_cm1
+        self.model_wavenumbers_cm1 = model_wavenumbers_cm1
+
+    def __call__(self, intensities: FloatArray) -> np.ndarray:
+        X = resample_matrix(intensities, self.wavenumbers_cm1, self.model_wavenumbers_cm1)
+        # Features are passed as a DataFrame, as in `BatchClassifier.fit`
+        return self.pipeline.predict(pd.DataFrame(X))
+
+
+class RamanMap:
+    """Hyperspectral map backed by a memory-mapped `(x, y, wavenumber)` cube, or by a
+    `(point, wavenumber)` array for scans of scattered points.
+
+    Use `RamanMap.from_renishaw_txtfile` to create a map from a multipoint scan, or
+    `RamanMap.open` to open a map that was created before.
+
+    Attributes:
+        directory : Path
+            Directory holding the cube, wavenumbers, and positions of the map.
+        layout : str
+            "grid" for raster scans, "points" for scans of scattered points.
+        cube : np.memmap
+            Read-only intensities of shape (num_x, num_y, num_wavenumbers), NaN where no spectrum
+            was recorded, or of shape (num_points, num_wavenumbers) for the "points" layout.
+        wavenumbers_cm1 : array-like
+            Wavenumbers of the last axis of the cube.
+        positions : array-like
+            (x, y) position of each recorded spectrum, as in the txt file.
+        mask : array-like
+            Whether a spectrum was recorded at each (x, y) pixel of the grid (or at each point).
+        x_um, y_um : array-like | None
+            Positions of the grid along the first and second axis of the cube ("grid" only).
+
+    Examples:
+        The bundled scan of 3 points picked on a plate does not fit a grid
+        >>> raman_map = RamanMap.from_renishaw_txtfile(txt_filepath, "cache/CC-124_TAP_plate")
+        >>> raman_map.layout, raman_map.shape
+        ('points', (3, 1015))
+        >>> raman_map.map_tiles(lambda intensities: intensities.max(axis=1)).shape
+        (3,)
+
+        whereas a raster scan of 40 x 30 positions, 10 µm apart along x and 5 µm along y does
+        >>> raman_map = RamanMap.from_renishaw_txtfile(raster_filepath, "cache/raster")
+        >>> raman_map.layout, raman_map.shape
+        ('grid', (40, 30, 1015))
+    """
+
+    def __init__(self, directory: str | Path):
+        self.directory = Path(directory)
+        self.cube = np.load(self.directory / MAP_FILENAMES["cube"], mmap_mode="r")
+        self.wavenumbers_cm1 = np.load(self.directory / MAP_FILENAMES["wavenumbers_cm1"])
+        self.positions = np.load(self.directory / MAP_FILENAMES["positions"])
+        self.mask = np.load(self.directory / MAP_FILENAMES["mask"])
+        info = json.loads((self.directory / MAP_FILENAMES["info"]).read_text())
+        self.layout = info["layout"]
+        self.x_um = np.array(info["x_um"]) if self.layout == "grid" else None
+        self.y_um = np.array(info["y_um"]) if self.layout == "grid" else None
+
+    @classmethod
+    def open(cls, directory: str | Path) -> "RamanMap":
+        """Open a map that was written to `directory` before."""
+        return cls(directory)
+
+    @classmethod
+    def from_renishaw_txtfile(
+        cls,
+        source: str | Path | bytes,
+        directory: str | Path,
+        layout: str | None = None,
+        pixel_size: float | tuple[float, float] | None = None,
+        chunk_size: int = 1_000_000,
+        dtype: type = np.float32,
+    ) -> "RamanMap":
+        """Write the spectra of a Renishaw multipoint txt file into a memory-mapped cube.
+
+        The file is parsed twice in chunks of `chunk_size` rows: once to find the positions and
+        the wavenumbers, and once to copy the intensities into the cube.
+
+        Args:
+            source:
+                Path or contents (e.g. a member of a tar file) of the txt file.
+            directory:
+                Directory in which to write the map.
+            layout:
+                "grid" to snap the positions to a grid, "points" to keep one spectrum per point.
+                Detected with `is_grid_scan` if not provided; "grid" raises a ValueError for
+                scans that do not fit a grid.
+            pixel_size:
+                Spacing (dx, dy) of the grid onto which to snap the positions (see
+                `get_grid_indices`).
+            chunk_size:
+                Number of rows of the txt file to parse at once.
+            dtype:
+                Data type of the cube; float32 halves the size on disk compared to float64.
+        """
+        positions, wavenumbers_cm1 = _scan_multipoint_file(source, chunk_size)
+        is_grid = is_grid_scan(positions, pixel_size)
+        if layout is None:
+            layout = "grid" if is_grid else "points"
+        if layout == "grid":
+            if not is_grid:
+                raise ValueError(
+                    "The points of the scan do not fit a regular grid (or several fall onto the "
+                    "same pixel); use the 'points' layout, or a different `pixel_size`."
+                )
+            indices, x_um, y_um = get_grid_indices(positions, pixel_size)
+            spatial_shape = (x_um.size, y_um.size)
+            info = {"layout": layout, "x_um": x_um.tolist(), "y_um": y_um.tolist()}
+        elif layout == "points":
+            spatial_shape = (positions.shape[0],)
+            info = {"layout": layout}
+        else:
+            raise ValueError(f"Unknown layout '{layout}', expected 'grid' or 'points'.")
+
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        num_wavenumbers = wavenumbers_cm1.size
+        cube = np.lib.format.open_memmap(
+            directory / MAP_FILENAMES["cube"],
+            mode="w+",
+            dtype=dtype,
+            shape=(*spatial_shape, num_wavenumbers),
+        )
+        if layout == "grid":
+            cube[:] = np.nan
+
+        start = 0
+        for values in _iter_multipoint_chunks(source, chunk_size):
+            rows = start + np.arange(values.shape[0])
+            points, columns = np.divmod(rows, num_wavenumbers)
+            if layout == "grid":
+                cube[indices[points, 0], indices[points, 1], columns] = values[:, 3]
+            else:
+                cube[points, columns] = values[:, 3]
+            start += values.shape[0]
+        cube.flush()
+        del cube
+
+        np.save(directory / MAP_FILENAMES["wavenumbers_cm1"], wavenumbers_cm1)
+        np.save(directory / MAP_FILENAMES["positions"], positions)
+        mask = np.zeros(spatial_shape, dtype=bool)
+        mask[tuple(indices.T) if layout == "grid" else slice(None)] = True
+        np.save(directory / MAP_FILENAMES["mask"], mask)
+        (directory / MAP_FILENAMES["info"]).write_text(json.dumps(info))
+        return cls(directory)
+
+    @property
+    def shape(self) -> tuple[int, ...]:
+        return self.cube.shape
+
+    def iter_tiles(self, tile_size: int = 64) -> Iterator[Tile]:
+        """Iterate over (x, y) slices of the cube of at most `tile_size` pixels per side, or over
+        slices of at most `tile_size`² points for the "points" layout."""
+        if self.layout == "points":
+            num_points = self.cube.shape[0]
+            for start in range(0, num_points, tile_size**2):
+                yield (slice(start, min(start + tile_size**2, num_points)),)
+            return
+
+        num_x, num_y, _num_wavenumbers = self.cube.shape
+        for x_start in range(0, num_x, tile_size):
+            for y_start in range(0, num_y, tile_size):
+                yield (
+                    slice(x_start, min(x_start + tile_size, num_x)),
+                    slice(y_start, min(y_start + tile_size, num_y)),
+                )
+
+    def _run_tiles(
+        self,
+        function: Callable,
+        tile_size: int,
+        num_workers: int | None,
+        output_filepath: Path | None = None,
+    ) -> Iterator[tuple[Tile, NDArray[np.bool_], np.ndarray | None]]:
+        """Run `_process_tile` on each tile, in this process or in a pool of worker processes."""
+        initargs = (self.directory / MAP_FILENAMES["cube"], function, output_filepath)
+        tiles = list(self.iter_tiles(tile_size))
+        if num_workers is None or num_workers <= 1 or len(tiles) < 2:
+            _init_worker(*initargs)
+            try:
+                yield from map(_process_tile, tiles)
+            finally:
+                _worker_state.clear()
+            return
+
+        with ProcessPoolExecutor(
+            max_workers=min(num_workers, len(tiles)),
+            initializer=_init_worker,
+            initargs=initargs,
+        ) as executor:
+            yield from executor.map(_process_tile, tiles)
+
+    def map_tiles(
+        self,
+        function: Callable,
+        tile_size: int = 64,
+        num_workers: int | None = None,
+    ) -> np.ndarray:
+        """Apply a function to the spectra of the map tile by tile, and arrange the results into
+        an image.
+
+        Args:
+            function:
+                Function mapping intensities of shape (num_pixels, num_wavenumbers) to a value of
+                each pixel, of shape (num_pixels,) or (num_pixels, num_channels). Must be
+                picklable (e.g. defined at module level) if `num_workers` > 1.
+            tile_size:
+                Number of pixels per side of each tile.
+            num_workers:
+                Number of worker processes among which to divide the tiles. Runs in this process
+                if not provided.
+
+        Returns:
+            image:
+                Result of shape (num_x, num_y) or (num_x, num_y, num_channels), NaN (or None for
+                non-numeric results such as class labels) at pixels without a spectrum. Of shape
+                (num_points,) or (num_points, num_channels) for the "points" layout.
+        """
+        image = None
+        for tile, measured, result in self._run_tiles(function, tile_size, num_workers):
+            if result is None:
+                continue
+            if image is None:
+                is_numeric = np.issubdtype(result.dtype, np.number)
+                image = np.full(
+                    (*self.cube.shape[:-1], *result.shape[1:]),
+                    np.nan if is_numeric else None,
+                    dtype=np.float64 if is_numeric else object,
+                )
+            image[tile][measured] = result
+        if image is None:
+            raise ValueError("No spectra were recorded in the map.")
+        return image
+
+    def preprocess(
+        self,
+        function: Callable,
+        directory: str | Path,
+        tile_size: int = 64,
+        num_workers: int | None = None,
+    ) -> "RamanMap":
+        """Apply a preprocessing function (e.g. baseline subtraction) to the spectra of the map
+        tile by tile, writing the result into a new memory-mapped map.
+
+        Args:
+            function:
+                Function mapping intensities of shape (num_pixels, num_wavenumbers) to
+                preprocessed intensities of the same shape. Must be picklable (e.g. defined at
+                module level) if `num_workers` > 1.
+            directory:
+                Directory in which to write the preprocessed map.
+            tile_size:
+                Number of pixels per side of each tile.
+            num_workers:
+                Number of worker processes among which to divide the tiles, each of which writes
+                its tiles straight into the new cube.
+        """
+        directory = Path(directory)
+        if directory.resolve() == self.directory.resolve():
+            raise ValueError("Cannot preprocess a map in place.")
+        directory.mkdir(parents=True, exist_ok=True)
+        output_filepath = directory / MAP_FILENAMES["cube"]
+        output = np.lib.format.open_memmap(
+            output_filepath, mode="w+", dtype=self.cube.dtype, shape=self.cube.shape
+        )
+        output[:] = np.nan
+        output.flush()
+        del output
+
+        for _result in self._run_tiles(function, tile_size, num_workers, output_filepath):
+            pass
+
+        for name in ("wavenumbers_cm1", "positions", "mask", "info"):
+            (directory / MAP_FILENAMES[name]).write_bytes(
+                (self.directory / MAP_FILENAMES[name]).read_bytes()
+            )
+        return RamanMap(directory)
+
+    def predict_image(
+        self,
+        model: str | Path | dict,
+        tile_size: int = 64,
+        num_workers: int | None = None,
+    ) -> NDArray[np.object_]:
+        """Classify the spectrum of each pixel with a fitted pipeline.
+
+        Args:
+            model:
+                Path of a model saved with `analysis.serve.save_model`, or the loaded model.
+            tile_size:
+                Number of pixels per side of each tile.
+            num_workers:
+                Number of worker processes among which to divide the tiles. The pipeline is sent
+                to each worker once, rather than along with each tile.
+
+        Returns:
+            labels_image:
+                Predicted class of each pixel, of shape (num_x, num_y), None at pixels without a
+                spectrum. Of shape (num_points,) for the "points" layout.
+        """
+        # Imported here, as loading a model pulls in the dependencies of the pipeline
+        from .serve import load_model
+
+        bundle = model if isinstance(model, dict) else load_model(model)
+        predictor = PipelinePredictor(
+            bundle["pipeline"], self.wavenumbers_cm1, bundle["wavenumbers_cm1"]
+        )
+        return self.map_tiles(predictor, tile_size, num_workers)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Grid indices and positions of the recorded pixels, e.g. to join per-pixel results."""
+        if self.layout == "points":
+            return pd.DataFrame(
+                {
+                    "point_index": np.arange(self.positions.shape[0]),
+                    "x_um": self.positions[:, 0],
+                    "y_um": self.positions[:, 1],
+                }
+            )
+        x_index, y_index = np.nonzero(self.mask)
+        return pd.DataFrame(
+            {
+                "x_index": x_index,
+                "y_index": y_index,
+                "x_um": self.x_um[x_index],
+                "y_um": self.y_um[y_index],
+            }
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f"{type(self).__name__}({os.fspath(self.directory)!r}, layout={self.layout!r}, "
+            f"shape={self.shape})"
+        )
+
+
+def _make_raster_scan(
+    shape: tuple[int, int],
+    pixel_size: tuple[float, float],
+    jitter_um: float,
+    num_wavenumbers: int = 20,
+    seed: int = 0,
+) -> bytes:
+    """Renishaw multipoint txt file of a serpentine raster scan, with Gaussian jitter of the
+    stage readout. The intensities of each point are its flat (x, y) index in the grid."""
+    rng = np.random.default_rng(seed)
+    wavenumbers_cm1 = np.linspace(1800, 100, num_wavenumbers)
+    lines = ["#X\t\t#Y\t\t#Wave\t\t#Intensity\n"]
+    for y_index in range(shape[1]):
+        # Every other row is scanned backwards
+        x_indices = range(shape[0]) if y_index % 2 == 0 else reversed(range(shape[0]))
+        for x_index in x_indices:
+            x, y = np.array([x_index, y_index]) * pixel_size + rng.normal(0, jitter_um, size=2)
+            intensity = x_index * shape[1] + y_index
+            lines.extend(f"{x:.6f}\t{y:.6f}\t{w:.6f}\t{intensity}\n" for w in wavenumbers_cm1)
+    return "".join(lines).encode()
+
+
+def check_grid_snapping(
+    jitters_um: tuple[float, ...] = (0.0, 0.05, 0.3),
+    shape: tuple[int, int] = (40, 30),
+    pixel_size: tuple[float, float] = (10.0, 5.0),
+) -> pd.DataFrame:
+    """Check that synthetic serpentine raster scans with jittered positions are stored as a cube
+    of the shape of their grid, with each spectrum at its own pixel.
+
+    Returns:
+        check:
+            Layout and shape of the map, and whether it matches the raster, for each jitter.
+    """
+    rows = []
+    for jitter_um in jitters_um:
+        source = _make_raster_scan(shape, pixel_size, jitter_um)
+        with tempfile.TemporaryDirectory() as directory:
+            raman_map = RamanMap.from_renishaw_txtfile(source, directory)
+            expected_image = np.arange(shape[0] * shape[1]).reshape(shape)
+            matches = raman_map.shape[:-1] == shape and np.array_equal(
+                raman_map.cube[..., 0], expected_image
+            )
+            rows.append(
+                {
+                    "jitter_um": jitter_um,
+                    "layout": raman_map.layout,
+                    "shape": raman_map.shape,
+                    "matches": matches,
+                }
+            )
+            del raman_map
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check that jittered raster scans are snapped onto their grid."
+    )
+    parser.add_argument("--jitters-um", type=float, nargs="+", default=[0.0, 0.05, 0.3])
+    args = parser.parse_args()
+
+    check = check_grid_snapping(tuple(args.jitters_um))
+    print(check.to_string(index=False))
+    if not check["matches"].all():
+        raise SystemExit("Some raster scans were not snapped onto their grid.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,524 @@
+"""
+# Incremental ingestion
+
+New acquisitions land under `data/<Instrument>/` throughout the day, either as loose spectrum
+files or inside `chlamy_spectra.tar` archives. Rather than reloading everything, this module
+keeps track of which files (and tar members) have been processed by the SHA-256 hash of their
+contents in a small SQLite state store, such that each run only parses new or changed files.
+
+The spectra of each run are resampled onto a fixed wavenumber axis and appended to a cache of
+chunks (`chunk_000000.npy` for the spectral matrix, `chunk_000000.csv` for the corresponding
+metadata). When a file changes, its new spectra are appended and its old spectra are ignored
+from then on, so the cost of each update only depends on the amount of new data. Files and tar
+members that have been removed from the data directory are dropped from the state store on the
+next run, after which their spectra are ignored as well. A state store (and cache) thus belongs
+to a single data directory.
+
+Files that are still being written are left for a later run: files modified less than
+`settle_s` seconds ago are skipped, and files (or tar members) that cannot be read, cannot be
+parsed, or hold spectra of fewer than `MIN_NUM_WAVENUMBERS` wavenumbers (e.g. a csv file cut off
+after a few rows) are logged and left unrecorded, without affecting the other files of the run.
+
+## Usage
+>>> from analysis.ingest import ingest, load_cache
+>>> X_new, metadata_new = ingest(cache_directory="cache", model_filepath="model.joblib")
+>>> X, metadata = load_cache("cache")
+"""
+
+import argparse
+import hashlib
+import logging
+import sqlite3
+import tarfile
+import time
+from collections.abc import Callable
+from fnmatch import fnmatch
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from numpy.typing import NDArray
+
+from .load_spectra import (
+    CHLAMY_SPECTRA_PATTERNS,
+    DATA_DIRECTORY,
+    INSTRUMENT_DIRECTORIES,
+    OPENRAMAN_CALIBRATION_FILENAMES,
+    SPECIES,
+    infer_sample_info,
+    load_openraman_buffers,
+)
+from .readers import parse_buffers, sniff_format, to_raman_spectra
+from .resampling import resample_spectra
+
+FloatArray = NDArray[np.float64]
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIRECTORY = DATA_DIRECTORY.parent / "cache"
+DEFAULT_WAVENUMBERS_CM1 = np.arange(300, 3200, 1.0)
+
+# Loose OpenRAMAN calibration files within the OpenRAMAN data directory
+OPENRAMAN_CALIBRATION_PATTERNS = ["neon_*.csv", "acetonitrile_*.csv"]
+
+# Minimum number of wavenumbers of a spectrum, below which its file is taken to be incomplete
+MIN_NUM_WAVENUMBERS = 100
+
+
+class IngestionState:
+    """SQLite store of the processed files and tar members.
+
+    Two tables are kept:
+    - `files`: size and modification time of each file in the data directory, by which unchanged
+      files (in particular big tar files) are skipped without reading them.
+    - `sources`: hash of the contents of each file or tar member (`member` is empty for loose
+      files), along with the cache chunk holding its spectra.
+    """
+
+    def __init__(self, filepath: str | Path):
+        self.connection = sqlite3.connect(filepath)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS sources (
+                path TEXT,
+                member TEXT,
+                sha256 TEXT,
+                chunk INTEGER,
+                num_spectra INTEGER,
+                ingested_at REAL,
+                PRIMARY KEY (path, member)
+            );
+            """
+        )
+
+    def is_unchanged(self, filepath: Path) -> bool:
+        stat = filepath.stat()
+        row = self.connection.execute(
+            "SELECT size, mtime_ns FROM files WHERE path = ?", (str(filepath),)
+        ).fetchone()
+        return row == (stat.st_size, stat.st_mtime_ns)
+
+    def get_hash(self, path: str, member: str) -> str | None:
+        row = self.connection.execute(
+            "SELECT sha256 FROM sources WHERE path = ? AND member = ?", (path, member)
+        ).fetchone()
+        return row[0] if row else None
+
+    def get_next_chunk(self) -> int:
+        (chunk,) = self.connection.execute("SELECT MAX(chunk) FROM sources").fetchone()
+        return 0 if chunk is None else chunk + 1
+
+    def record(self, sources: list[tuple[str, str, str, int]], chunk: int, filepaths: list[Path]):
+        """Record processed sources as (path, member, sha256, num_spectra) and files in a single
+        transaction, such that the state never runs ahead of the cache."""
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?, ?)",
+                [(*source[:3], chunk, source[3], now) for source in sources],
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                [
+                    (str(filepath), filepath.stat().st_size, filepath.stat().st_mtime_ns)
+                    for filepath in filepaths
+                ],
+            )
+
+    def get_sources(self) -> pd.DataFrame:
+        return pd.read_sql("SELECT path, member, chunk FROM sources", self.connection)
+
+    def remove_members(self, path: str, members: set[str]):
+        """Forget the members of a file that are not among `members` (i.e. have been removed)."""
+        rows = self.connection.execute("SELECT member FROM sources WHERE path = ?", (path,))
+        removed = [(path, member) for (member,) in rows.fetchall() if member not in members]
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM sources WHERE path = ? AND member = ?", removed
+            )
+
+    def remove_files(self, paths: set[str]):
+        """Forget the files (and their members) that are not among `paths`."""
+        rows = self.connection.execute("SELECT path FROM files UNION SELECT path FROM sources")
+        removed = [(path,) for (path,) in rows.fetchall() if path not in paths]
+        with self.connection:
+            self.connection.executemany("DELETE FROM files WHERE path = ?", removed)
+            self.connection.executemany("DELETE FROM sources WHERE path = ?", removed)
+
+    def close(self):
+        self.connection.close()
+
+
+def _iter_new_sources(filepath: Path, instrument: tuple[str, int]):
+    """Iterate over the (member, buffer, sha256) of the new or changed cell spectra in a file."""
+    if tarfile.is_tarfile(filepath):
+        pattern = CHLAMY_SPECTRA_PATTERNS[instrument]
+        with tarfile.open(filepath, "r") as tar:
+            for member in tar:
+                if member.isfile() and fnmatch(member.name, pattern):
+                    buffer = tar.extractfile(member).read()
+                    yield member.name, buffer, hashlib.sha256(buffer).hexdigest()
+                tar.members.clear()
+    else:
+        buffer = filepath.read_bytes()
+        yield "", buffer, hashlib.sha256(buffer).hexdigest()
+
+
+def _is_cell_spectrum(filename: str, buffer: bytes) -> bool:
+    """Whether a file holds cell spectra (as opposed to e.g. acetonitrile or calibrations)."""
+    try:
+        infer_sample_info(filename)
+        sniff_format(buffer)
+    except (StopIteration, ValueError):
+        return False
+    return True
+
+
+def _get_openraman_calibration_buffers(filepath: Path) -> list[bytes]:
+    """Calibration files of OpenRAMAN spectra, either from within the same tar file or from the
+    OpenRAMAN data directory."""
+    if tarfile.is_tarfile(filepath):
+        with tarfile.open(filepath, "r") as tar:
+            return [tar.extractfile(name).read() for name in OPENRAMAN_CALIBRATION_FILENAMES]
+    calibration_buffers = []
+    for pattern in OPENRAMAN_CALIBRATION_PATTERNS:
+        calibration_filepath = sorted(filepath.parent.glob(pattern))[0]
+        calibration_buffers.append(calibration_filepath.read_bytes())
+    return calibration_buffers
+
+
+def _load_each(load: Callable[[list[dict]], list[list]], sources: list[dict]) -> list:
+    """Load the spectra of each source in one call, or one source at a time if that fails, such
+    that a source that cannot be loaded does not affect the others.
+
+    Returns:
+        loaded:
+            Spectra of each source, or the error with which it failed.
+    """
+    try:
+        return load(sources)
+    except Exception:
+        loaded = []
+        for source in sources:
+            try:
+                loaded.extend(load([source]))
+            except Exception as error:
+                loaded.append(error)
+        return loaded
+
+
+def _check_spectra(source_spectra: list) -> list:
+    """Reject the spectra of an incomplete file (e.g. one that is still being written)."""
+    num_wavenumbers = min((len(spectrum.wavenumbers_cm1) for spectrum in source_spectra), default=0)
+    if num_wavenumbers < MIN_NUM_WAVENUMBERS:
+        raise ValueError(
+            f"Spectra of {num_wavenumbers} wavenumbers (fewer than {MIN_NUM_WAVENUMBERS}); the "
+            "file is likely incomplete."
+        )
+    return source_spectra
+
+
+def _load_pending(pending: list[dict]) -> tuple[list, pd.DataFrame, list[tuple[dict, Exception]]]:
+    """Parse the pending sources into spectra and their metadata.
+
+    Returns:
+        spectra:
+            Spectra of the sources that were loaded.
+        metadata:
+            Metadata corresponding to each spectrum.
+        failed:
+            Sources that could not be loaded, along with the error.
+    """
+    spectra = []
+    records = []
+    # OpenRAMAN spectra are calibrated per file they come from
+    openraman_sources = {}
+    other_sources = []
+    for source in pending:
+        if source["instrument"] == ("openraman", 532):
+            openraman_sources.setdefault(source["filepath"], []).append(source)
+        else:
+            other_sources.append(source)
+
+    def load_openraman(sources: list[dict]) -> list[list]:
+        calibration_buffers = _get_openraman_calibration_buffers(sources[0]["filepath"])
+        buffers = [source["buffer"] for source in sources]
+        return [[spectrum] for spectrum in load_openraman_buffers(buffers, calibration_buffers)]
+
+    def load_other(sources: list[dict]) -> list[list]:
+        parsed = parse_buffers([source["buffer"] for source in sources])
+        return [to_raman_spectra(result) for result in parsed]
+
+    loaded = []
+    for sources in openraman_sources.values():
+        loaded.extend(zip(sources, _load_each(load_openraman, sources), strict=True))
+    loaded.extend(zip(other_sources, _load_each(load_other, other_sources), strict=True))
+
+    failed = []
+    for source, source_spectra in loaded:
+        try:
+            if isinstance(source_spectra, Exception):
+                raise source_spectra
+            _check_spectra(source_spectra)
+        except Exception as error:
+            failed.append((source, error))
+            continue
+        instrument, wavelength_nm = source["instrument"]
+        strain, medium = infer_sample_info(source["member"] or source["filepath"].name)
+        for i, spectrum in enumerate(source_spectra):
+            spectra.append(spectrum)
+            records.append(
+                {
+                    "instrument": instrument,
+                    "λ_nm": wavelength_nm,
+                    "species": SPECIES[strain],
+                    "strain": strain,
+                    "medium": medium,
+                    "path": source["path"],
+                    "member": source["member"],
+                    "sha256": source["sha256"],
+                    "index": i,
+                }
+            )
+    return spectra, pd.DataFrame.from_records(records), failed
+
+
+def ingest(
+    data_directory: str | Path = DATA_DIRECTORY,
+    cache_directory: str | Path = DEFAULT_CACHE_DIRECTORY,
+    wavenumbers_cm1: FloatArray | None = None,
+    model_filepath: str | Path | None = None,
+    batch_size: int = 1024,
+    settle_s: float = 60.0,
+) -> tuple[FloatArray, pd.DataFrame]:
+    """Ingest the new or changed cell spectra in the data directory.
+
+    Files that are still being written (see `settle_s`), or that cannot be loaded, are logged and
+    left unrecorded, such that they are ingested again by the next run.
+
+    Args:
+        data_directory:
+            Directory containing a subdirectory for each instrument (see `INSTRUMENT_DIRECTORIES`).
+        cache_directory:
+            Directory of the state store and the cache of spectra.
+        wavenumbers_cm1:
+            Wavenumber axis of the cached spectral matrix. Fixed by the first run; defaults to
+            `DEFAULT_WAVENUMBERS_CM1`.
+        model_filepath:
+            Model saved with `analysis.serve.save_model`. When provided, the new spectra are
+            classified, and the predictions are added to the metadata as "prediction".
+        batch_size:
+            Number of files (or tar members) per cache chunk.
+        settle_s:
+            Minimum time since a file was last modified, below which it is taken to be still
+            being written and is left for a later run.
+
+    Returns:
+        X_new:
+            Spectral matrix of the newly ingested spectra.
+        metadata_new:
+            Metadata of the newly ingested spectra.
+    """
+    cache_directory = Path(cache_directory)
+    cache_directory.mkdir(parents=True, exist_ok=True)
+
+    # The wavenumber axis is fixed by the first run, so that all chunks can be stacked
+    wavenumbers_filepath = cache_directory / "wavenumbers_cm1.npy"
+    if wavenumbers_filepath.exists():
+        cached_wavenumbers_cm1 = np.load(wavenumbers_filepath)
+        if wavenumbers_cm1 is not None and not np.array_equal(
+            wavenumbers_cm1, cached_wavenumbers_cm1
+        ):
+            raise ValueError(f"Cache in {cache_directory} uses a different wavenumber axis.")
+        wavenumbers_cm1 = cached_wavenumbers_cm1
+    else:
+        if wavenumbers_cm1 is None:
+            wavenumbers_cm1 = DEFAULT_WAVENUMBERS_CM1
+        np.save(wavenumbers_filepath, wavenumbers_cm1)
+
+    model = None
+    if model_filepath is not None:
+        # Imported here as the service is not needed unless predictions are requested
+        from .serve import load_model
+
+        model = load_model(model_filepath)
+
+    state = IngestionState(cache_directory / "state.sqlite")
+    X_chunks = []
+    metadata_chunks = []
+
+    # Files that could not be loaded (entirely), which are not recorded such that they are retried
+    failed_paths = set()
+
+    def flush(pending: list[dict], pending_filepaths: list[Path]):
+        """Load the pending sources, write them to a new chunk, and record them as processed."""
+        chunk = state.get_next_chunk()
+        sources = []
+        if pending:
+            spectra, metadata, failed = _load_pending(pending)
+            for source, error in failed:
+                logger.warning("Skipping %s %s: %s", source["path"], source["member"], error)
+                failed_paths.add(source["path"])
+            failed_ids = {id(source) for source, _error in failed}
+            pending = [source for source in pending if id(source) not in failed_ids]
+        if pending:
+            X = resample_spectra(spectra, wavenumbers_cm1)
+            if model is not None:
+                X_model = resample_spectra(spectra, model["wavenumbers_cm1"])
+                metadata["prediction"] = model["pipeline"].predict(pd.DataFrame(X_model))
+            np.save(cache_directory / f"chunk_{chunk:06d}.npy", X)
+            metadata.to_csv(cache_directory / f"chunk_{chunk:06d}.csv", index=False)
+            X_chunks.append(X)
+            metadata_chunks.append(metadata)
+
+            num_spectra = metadata.groupby(["path", "member"]).size().to_dict()
+            sources = [
+                (
+                    source["path"],
+                    source["member"],
+                    source["sha256"],
+                    num_spectra.get((source["path"], source["member"]), 0),
+                )
+                for source in pending
+            ]
+        pending_filepaths = [
+            filepath for filepath in pending_filepaths if str(filepath) not in failed_paths
+        ]
+        state.record(sources, chunk, pending_filepaths)
+
+    try:
+        pending = []
+        pending_filepaths = []
+        present_paths = set()
+        for instrument, directory_name in INSTRUMENT_DIRECTORIES.items():
+            directory = Path(data_directory) / directory_name
+            if not directory.is_dir():
+                continue
+            for filepath in sorted(directory.iterdir()):
+                if not filepath.is_file():
+                    continue
+                present_paths.add(str(filepath))
+                if state.is_unchanged(filepath):
+                    continue
+                if time.time() - filepath.stat().st_mtime < settle_s:
+                    logger.info("Skipping %s, which is likely still being written.", filepath)
+                    continue
+                present_members = set()
+                try:
+                    for member, buffer, sha256 in _iter_new_sources(filepath, instrument):
+                        present_members.add(member)
+                        if state.get_hash(str(filepath), member) == sha256:
+                            continue
+                        if not _is_cell_spectrum(member or filepath.name, buffer):
+                            continue
+                        pending.append(
+                            {
+                                "instrument": instrument,
+                                "filepath": filepath,
+                                "path": str(filepath),
+                                "member": member,
+                                "buffer": buffer,
+                                "sha256": sha256,
+                            }
+                        )
+                        if len(pending) >= batch_size:
+                            flush(pending, pending_filepaths)
+                            pending = []
+                            pending_filepaths = []
+                except (OSError, tarfile.TarError) as error:
+                    # e.g. a tar file that is still being written; the members read so far are
+                    # kept, and the file is read again by the next run
+                    logger.warning("Skipping the rest of %s: %s", filepath, error)
+                    failed_paths.add(str(filepath))
+                    continue
+                # Members that have been removed from a tar file since the last run
+                state.remove_members(str(filepath), present_members)
+                # Files are only marked as processed along with their last member
+                pending_filepaths.append(filepath)
+        flush(pending, pending_filepaths)
+        # Files that have been removed from the data directory since the last run
+        state.remove_files(present_paths)
+    finally:
+        state.close()
+
+    if not X_chunks:
+        return np.empty((0, len(wavenumbers_cm1))), pd.DataFrame()
+    return np.concatenate(X_chunks), pd.concat(metadata_chunks, ignore_index=True)
+
+
+def load_cache(
+    cache_directory: str | Path = DEFAULT_CACHE_DIRECTORY,
+) -> tuple[FloatArray, pd.DataFrame]:
+    """Load the cached spectral matrix and metadata of the current version of every file.
+
+    Returns:
+        X:
+            Spectral matrix of shape (num_spectra, num_wavenumbers).
+        metadata:
+            Metadata corresponding to each row of `X`.
+    """
+    cache_directory = Path(cache_directory)
+    wavenumbers_cm1 = np.load(cache_directory / "wavenumbers_cm1.npy")
+    chunk_filepaths = sorted(cache_directory.glob("chunk_*.npy"))
+    if not chunk_filepaths:
+        return np.empty((0, wavenumbers_cm1.size)), pd.DataFrame()
+
+    X = np.concatenate([np.load(filepath) for filepath in chunk_filepaths])
+    metadata = pd.concat(
+        [
+            pd.read_csv(filepath.with_suffix(".csv"), keep_default_na=False).assign(
+                chunk=int(filepath.stem.removeprefix("chunk_"))
+            )
+            for filepath in chunk_filepaths
+        ],
+        ignore_index=True,
+    )
+
+    # Only keep the spectra from the chunk of the current version of each file, dropping those
+    # of earlier versions (even if identical, e.g. after a revert) and of removed files
+    state = IngestionState(cache_directory / "state.sqlite")
+    try:
+        sources = state.get_sources()
+    finally:
+        state.close()
+    is_current = (
+        metadata[["path", "member", "chunk"]]
+        .merge(sources, how="left", indicator=True)["_merge"]
+        .eq("both")
+        .to_numpy()
+    )
+    metadata = metadata[is_current].drop(columns="chunk").reset_index(drop=True)
+    return X[is_current], metadata
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest new spectra from the data directory.")
+    parser.add_argument("--data-directory", type=Path, default=DATA_DIRECTORY)
+    parser.add_argument("--cache-directory", type=Path, default=DEFAULT_CACHE_DIRECTORY)
+    parser.add_argument("--model", type=Path, default=None, help="Model to predict with.")
+    parser.add_argument(
+        "--settle-s",
+        type=float,
+        default=60.0,
+        help="Skip files modified less than this many seconds ago.",
+    )
+    args = parser.parse_args()
+
+    _X_new, metadata_new = ingest(
+        args.data_directory,
+        args.cache_directory,
+        model_filepath=args.model,
+        settle_s=args.settle_s,
+    )
+    print(f"Ingested {len(metadata_new)} new spectra.")
+    if "prediction" in metadata_new:
+        print(metadata_new.groupby(["path", "prediction"]).size().to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -3,16 +3,50 @@ import re
 import shutil
 import tarfile
 import tempfile
-from fnmatch import fnmatch
+from itertools import islice
 from pathlib import Path
 
 import pandas as pd
 from ramanalysis import RamanSpectrum
 from ramanalysis.readers import read_renishaw_multipoint_txt
 
+from .profiling import profile_info, profile_read, profiled, stage
+from .readers import iter_tar_members, parse_buffers, to_raman_spectra
+
 REPO_ROOT_DIRECTORY = Path(__file__).parents[2]
 DATA_DIRECTORY = REPO_ROOT_DIRECTORY / "data"
 
+# Map each (instrument, wavelength) combination to its directory within the data directory
+INSTRUMENT_DIRECTORIES = {
+    ("horiba", 785): "Horiba_MacroRAM",
+    ("openraman", 532): "OpenRAMAN",
+    ("renishaw", 785): "Renishaw_Qontor",
+    ("wasatch", 532): "Wasatch_WP532X",
+    ("wasatch", 785): "Wasatch_WP785X",
+}
+
+# Strain, media, species info of the cell cultures
+STRAINS = ["CC-124", "CC-125", "CC-1373"]
+MEDIA = ["MN", "TAP"]
+SPECIES = {
+    "CC-124": "C. reinhardtii",
+    "CC-125": "C. reinhardtii",
+    "CC-1373": "C. smithii",
+}
+
+# Patterns of the cell spectra and calibration files within each `chlamy_spectra.tar`
+CHLAMY_SPECTRA_PATTERNS = {
+    ("horiba", 785): "./chlamy_spectra/CC-*.txt",
+    ("openraman", 532): "./chlamy_spectra/CC-*/Pos*.csv",
+    ("wasatch", 532): "./chlamy_spectra/CC-*/Pos*.csv",
+    ("renishaw", 785): "./chlamy_spectra/2024*_cells*.txt",
+    ("wasatch", 785): "./chlamy_spectra/enlighten*.csv",
+}
+OPENRAMAN_CALIBRATION_FILENAMES = [
+    "./chlamy_spectra/calibration_data/neon_4x.csv",
+    "./chlamy_spectra/calibration_data/acetonitrile_4x.csv",
+]
+
 
 def tar_wrapper_single(
     tarpath: str | Path,
@@ -57,6 +91,42 @@ def tar_wrapper_multiple(
     return out
 
 
+def load_openraman_buffers(
+    buffers: list[bytes],
+    calibration_buffers: list[bytes],
+) -> list[RamanSpectrum]:
+    """Load and calibrate OpenRAMAN spectra from in-memory buffers.
+
+    The calibration is done by `RamanSpectrum.from_openraman_csvfiles`, which only accepts file
+    paths, so the calibration files are written to a temporary directory once for all spectra.
+
+    Args:
+        buffers:
+            Contents of each OpenRAMAN spectrum csv file.
+        calibration_buffers:
+            Contents of the neon and acetonitrile calibration csv files (in that order).
+    """
+    spectra = []
+    with tempfile.TemporaryDirectory() as tmp_directory:
+        calibration_filepaths = []
+        for i, calibration_buffer in enumerate(calibration_buffers):
+            calibration_filepath = Path(tmp_directory) / f"calibration_{i}.csv"
+            with stage("tempfile_io", nbytes=len(calibration_buffer)):
+                calibration_filepath.write_bytes(calibration_buffer)
+            calibration_filepaths.append(calibration_filepath)
+
+        tmp_filepath = Path(tmp_directory) / "spectrum.csv"
+        for buffer in buffers:
+            with stage("tempfile_io", nbytes=len(buffer)):
+                tmp_filepath.write_bytes(buffer)
+            with stage("calibration", nbytes=len(buffer)):
+                spectra.append(
+                    RamanSpectrum.from_openraman_csvfiles(tmp_filepath, *calibration_filepaths)
+                )
+    return spectra
+
+
+@profiled
 def load_acetonitrile_spectra() -> tuple[list[RamanSpectrum], list[str]]:
     """Load acetonitrile spectra from each instrument."""
     # Map spectrometer info to file paths
@@ -71,15 +141,17 @@ def load_acetonitrile_spectra() -> tuple[list[RamanSpectrum], list[str]]:
 
     # Load spectra
     spectra = [
-        RamanSpectrum.from_horiba_txtfile(filepaths[("horiba", 785)]),
-        RamanSpectrum.from_renishaw_txtfile(filepaths[("renishaw", 785)]),
-        RamanSpectrum.from_wasatch_csvfile(filepaths[("wasatch", 785)]),
-        RamanSpectrum.from_openraman_csvfiles(
+        profile_read(RamanSpectrum.from_horiba_txtfile, filepaths[("horiba", 785)]),
+        profile_read(RamanSpectrum.from_renishaw_txtfile, filepaths[("renishaw", 785)]),
+        profile_read(RamanSpectrum.from_wasatch_csvfile, filepaths[("wasatch", 785)]),
+        profile_read(
+            RamanSpectrum.from_openraman_csvfiles,
             filepaths[("openraman", 532)],
             openraman_neon_calibration,
             filepaths[("openraman", 532)],
+            stage_name="calibration",
         ),
-        RamanSpectrum.from_generic_csvfile(filepaths[("wasatch", 532)]),
+        profile_read(RamanSpectrum.from_generic_csvfile, filepaths[("wasatch", 532)]),
     ]
 
     # Convert spectrometer info into DataFrame
@@ -87,11 +159,12 @@ def load_acetonitrile_spectra() -> tuple[list[RamanSpectrum], list[str]]:
     return spectra, dataframe
 
 
+@profiled
 def load_cc124_tap_spectra() -> tuple[list[RamanSpectrum], list[str]]:
     """Load individual cell spectra from each instrument."""
     # Horiba
     txt_filepath = DATA_DIRECTORY / "Horiba_MacroRAM/CC-124-TAP-2.txt"
-    horiba_spectrum = RamanSpectrum.from_horiba_txtfile(txt_filepath)
+    horiba_spectrum = profile_read(RamanSpectrum.from_horiba_txtfile, txt_filepath)
 
     # OpenRAMAN -- a bit special because it needs to be calibrated
     csv_filepath = DATA_DIRECTORY / "OpenRAMAN/CC-124_TAP_Pos-2-000_002.csv"
@@ -99,25 +172,29 @@ def load_cc124_tap_spectra() -> tuple[list[RamanSpectrum], list[str]]:
         DATA_DIRECTORY / "OpenRAMAN/neon_n_n_n_solid_10000_0_5.csv",
         DATA_DIRECTORY / "OpenRAMAN/acetonitrile_n_n_n_solid_10000_0_5.csv",
     ]
-    openraman_spectrum = RamanSpectrum.from_openraman_csvfiles(
+    openraman_spectrum = profile_read(
+        RamanSpectrum.from_openraman_csvfiles,
         csv_filepath,
         *openraman_calibration_files,
+        stage_name="calibration",
     )
 
     # Renishaw -- a bit special because it comes from a multipoint scan, for which there is no
     # class method to automatically instantiate a `RamanSpectrum` object
     # There are 3 points to choose from, we will arbitrarily choose the first one
     txt_filepath = DATA_DIRECTORY / "Renishaw_Qontor/CC-124_TAP_plate_5x_3_points.txt"
-    wavenumbers_cm1, intensities, _positions = read_renishaw_multipoint_txt(txt_filepath)
+    wavenumbers_cm1, intensities, _positions = profile_read(
+        read_renishaw_multipoint_txt, txt_filepath
+    )
     renishaw_spectrum = RamanSpectrum(wavenumbers_cm1, intensities[0, :])
 
     # Wasatch 532 nm
     csv_filepath = DATA_DIRECTORY / "Wasatch_WP532X/CC-124_TAP_Pos-4-002_001.csv"
-    wasatch_532_spectrum = RamanSpectrum.from_generic_csvfile(csv_filepath)
+    wasatch_532_spectrum = profile_read(RamanSpectrum.from_generic_csvfile, csv_filepath)
 
     # Wasatch 785 nm
     csv_filepath = DATA_DIRECTORY / "Wasatch_WP785X/CC-124_TAP_WP-02071.csv"
-    wasatch_785_spectrum = RamanSpectrum.from_wasatch_csvfile(csv_filepath)
+    wasatch_785_spectrum = profile_read(RamanSpectrum.from_wasatch_csvfile, csv_filepath)
 
     # Compile spectra
     mapped_spectra = {
@@ -135,34 +212,35 @@ def load_cc124_tap_spectra() -> tuple[list[RamanSpectrum], list[str]]:
     return spectra, dataframe
 
 
-def load_chlamy_spectra():
-    """Load cell spectra from each instrument."""
-    # Map out strain, media, species info
-    strains = ["CC-124", "CC-125", "CC-1373"]
-    media = ["MN", "TAP"]
-    species = {
-        "CC-124": "C. reinhardtii",
-        "CC-125": "C. reinhardtii",
-        "CC-1373": "C. smithii",
-    }
+def infer_sample_info(filename: str) -> tuple[str, str]:
+    """Infer the strain and medium of a sample from the name of its file."""
+    strain_matches = [re.search(strain, filename) for strain in STRAINS]
+    medium_matches = [re.search(medium, filename) for medium in MEDIA]
+    strain = next(match for match in strain_matches if match is not None).group()
+    medium = next(match for match in medium_matches if match is not None).group()
+    if medium == "MN":
+        medium = "M-N"
+    return strain, medium
 
+
+@profiled
+def load_chlamy_spectra(data_directory: str | Path = DATA_DIRECTORY, batch_size: int = 256):
+    """Load cell spectra from each instrument.
+
+    Args:
+        data_directory:
+            Directory containing a subdirectory for each instrument, each holding a
+            `chlamy_spectra.tar` archive. Defaults to the data directory of this repository, but
+            can be pointed to e.g. synthetic archives from `analysis.synthetic_data`.
+        batch_size:
+            Number of files to parse at once (see `analysis.readers.parse_buffers`).
+    """
+    data_directory = Path(data_directory)
     mapped_tarpaths = {
-        ("openraman", 532): Path("data/OpenRAMAN/chlamy_spectra.tar"),
-        ("wasatch", 532): Path("data/Wasatch_WP532X/chlamy_spectra.tar"),
-        ("renishaw", 785): Path("data/Renishaw_Qontor/chlamy_spectra.tar"),
-        ("wasatch", 785): Path("data/Wasatch_WP785X/chlamy_spectra.tar"),
-    }
-    mapped_patterns = {
-        ("openraman", 532): "./chlamy_spectra/CC-*/Pos*.csv",
-        ("wasatch", 532): "./chlamy_spectra/CC-*/Pos*.csv",
-        ("renishaw", 785): "./chlamy_spectra/2024*_cells*.txt",
-        ("wasatch", 785): "./chlamy_spectra/enlighten*.csv",
-    }
-    mapped_readers = {
-        ("openraman", 532): RamanSpectrum.from_openraman_csvfiles,
-        ("wasatch", 532): RamanSpectrum.from_generic_csvfile,
-        ("renishaw", 785): read_renishaw_multipoint_txt,
-        ("wasatch", 785): RamanSpectrum.from_wasatch_csvfile,
+        ("openraman", 532): data_directory / "OpenRAMAN/chlamy_spectra.tar",
+        ("wasatch", 532): data_directory / "Wasatch_WP532X/chlamy_spectra.tar",
+        ("renishaw", 785): data_directory / "Renishaw_Qontor/chlamy_spectra.tar",
+        ("wasatch", 785): data_directory / "Wasatch_WP785X/chlamy_spectra.tar",
     }
 
     spectra = []
@@ -172,64 +250,42 @@ def load_chlamy_spectra():
     media_data = []
     # Big loopity loop through all the cell spectra within each tar file
     for (instrument, wavelength_nm), tarpath in mapped_tarpaths.items():
-        pattern = mapped_patterns[(instrument, wavelength_nm)]
-        reader = mapped_readers[(instrument, wavelength_nm)]
-        with tarfile.open(tarpath, "r") as tar:
-            for member in tar.getmembers():
-                if fnmatch(member.name, pattern):
-                    # Infer sample info from filepath
-                    strain_matches = [re.search(strain, member.name) for strain in strains]
-                    medium_matches = [re.search(medium, member.name) for medium in media]
-                    strain = next(match for match in strain_matches if match is not None).group()
-                    medium = next(match for match in medium_matches if match is not None).group()
-                    if medium == "MN":
-                        medium = "M-N"
-
-                    # Load OpenRAMAN spectra
-                    if instrument == "openraman":
-                        spectrum = tar_wrapper_multiple(
-                            tarpath=tarpath,
-                            filenames=[
-                                member.name,
-                                "./chlamy_spectra/calibration_data/neon_4x.csv",
-                                "./chlamy_spectra/calibration_data/acetonitrile_4x.csv",
-                            ],
-                            function=reader,
-                        )
+        with profile_info(instrument=instrument, λ_nm=wavelength_nm):
+            pattern = CHLAMY_SPECTRA_PATTERNS[(instrument, wavelength_nm)]
+            members = iter_tar_members(tarpath, pattern)
+
+            # Load OpenRAMAN spectra -- a bit special because each spectrum needs to be calibrated
+            if instrument == "openraman":
+                calibration_buffers = [
+                    buffer
+                    for filename in OPENRAMAN_CALIBRATION_FILENAMES
+                    for _name, buffer in iter_tar_members(tarpath, filename)
+                ]
+                while batch := list(islice(members, batch_size)):
+                    names, buffers = zip(*batch, strict=True)
+                    batch_spectra = load_openraman_buffers(buffers, calibration_buffers)
+                    for name, spectrum in zip(names, batch_spectra, strict=True):
+                        strain, medium = infer_sample_info(name)
                         spectra.append(spectrum)
                         instrument_data.append(instrument)
                         wavelength_data.append(wavelength_nm)
                         strain_data.append(strain)
                         media_data.append(medium)
 
-                    # Load Renishaw spectra
-                    elif instrument == "renishaw":
-                        wavenumbers_cm1, intensities, _positions = tar_wrapper_single(
-                            tarpath=tarpath,
-                            filename=member.name,
-                            function=reader,
-                        )
-                        for i in range(intensities.shape[0]):
-                            spectrum = RamanSpectrum(wavenumbers_cm1, intensities[i, :])
+            # Load Renishaw and Wasatch spectra -- the format of each file is detected from its
+            # contents, and files are parsed in batches. Renishaw files contain multiple spectra.
+            else:
+                while batch := list(islice(members, batch_size)):
+                    names, buffers = zip(*batch, strict=True)
+                    for name, parsed in zip(names, parse_buffers(buffers), strict=True):
+                        strain, medium = infer_sample_info(name)
+                        for spectrum in to_raman_spectra(parsed):
                             spectra.append(spectrum)
                             instrument_data.append(instrument)
                             wavelength_data.append(wavelength_nm)
                             strain_data.append(strain)
                             media_data.append(medium)
 
-                    # Load Wasatch spectra
-                    else:
-                        spectrum = tar_wrapper_single(
-                            tarpath=tarpath,
-                            filename=member.name,
-                            function=reader,
-                        )
-                        spectra.append(spectrum)
-                        instrument_data.append(instrument)
-                        wavelength_data.append(wavelength_nm)
-                        strain_data.append(strain)
-                        media_data.append(medium)
-
     # Create DataFrame in which to put instrument strain, species, and media info corresponding
     # to each spectrum
     data = {
@@ -240,5 +296,5 @@ def load_chlamy_spectra():
         "medium": media_data,
     }
     dataframe = pd.DataFrame(data)
-    dataframe["species"] = dataframe["strain"].map(species)
+    dataframe["species"] = dataframe["strain"].map(SPECIES)
     return spectra, dataframe
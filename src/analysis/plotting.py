@@ -1,18 +1,28 @@
-import arcadia_pycolor as apc
-import matplotlib.colors as mcolors
+from typing import TYPE_CHECKING
+
 import numpy as np
+import pandas as pd
 from numpy.typing import NDArray
 
+# arcadia_pycolor, matplotlib, and plotly are imported by the functions that use them, as they
+# take a while to import and are not needed by e.g. workers that only load spectra
+if TYPE_CHECKING:
+    import plotly.graph_objects as go
+
 FloatArray = NDArray[np.float64]
 
 
 def darken(color, factor: float = 0.6) -> str:
+    import matplotlib.colors as mcolors
+
     rgb = mcolors.to_rgb(color)
     rgb_darker = tuple(c * factor for c in rgb)
     return mcolors.to_hex(rgb_darker)
 
 
 def get_custom_colorpalette() -> dict[str | tuple[str, str], str]:
+    import arcadia_pycolor as apc
+
     # color palette for each (instrument, wavelength) combination
     greens = apc.palettes.green_shades.colors
     reds = apc.palettes.red_shades.colors
@@ -40,6 +50,8 @@ def get_custom_colorpalette() -> dict[str | tuple[str, str], str]:
 
 
 def get_default_plotly_layout() -> dict:
+    import arcadia_pycolor as apc
+
     layout = {
         "paper_bgcolor": apc.parchment.hex_code,
         "plot_bgcolor": apc.parchment.hex_code,
@@ -47,3 +59,256 @@ def get_default_plotly_layout() -> dict:
         "margin": {"l": 50, "r": 50, "t": 50, "b": 75},
     }
     return layout
+
+
+def lttb_downsample(
+    x: FloatArray,
+    y: FloatArray,
+    num_points: int,
+) -> tuple[FloatArray, FloatArray]:
+    """Downsample lines with the Largest-Triangle-Three-Buckets (LTTB) algorithm.
+
+    LTTB splits a line into `num_points - 2` buckets and keeps the point in each bucket that
+    forms the largest triangle with the point kept in the previous bucket and the average of the
+    next bucket, which preserves the shape of peaks far better than taking every n-th point.
+    Multiple lines of the same length are downsampled at once by passing 2D arrays.
+
+    Args:
+        x:
+            x values of the line(s), e.g. wavenumbers, of shape (num_values,) or
+            (num_lines, num_values).
+        y:
+            y values of the line(s), e.g. intensities, of shape (num_values,) or
+            (num_lines, num_values).
+        num_points:
+            Number of points to keep, including the first and last point.
+
+    Returns:
+        x_downsampled:
+            x values of the kept points.
+        y_downsampled:
+            y values of the kept points.
+    """
+    y = np.asarray(y, dtype=float)
+    x = np.broadcast_to(np.asarray(x, dtype=float), y.shape)
+    num_values = y.shape[-1]
+    if num_points >= num_values or num_points < 3:
+        return x, y
+
+    is_1d = y.ndim == 1
+    x = np.atleast_2d(x)
+    y = np.atleast_2d(y)
+    rows = np.arange(y.shape[0])
+
+    # Bucket edges of the points between the first and the last point
+    edges = np.linspace(1, num_values - 1, num_points - 1).astype(int)
+    indices = np.zeros((y.shape[0], num_points), dtype=int)
+    indices[:, -1] = num_values - 1
+    for i in range(num_points - 2):
+        start, stop = edges[i], edges[i + 1]
+        # Average of the next bucket (or the last point for the last bucket)
+        next_stop = edges[i + 2] if i + 2 < edges.size else num_values
+        x_next = x[:, stop:next_stop].mean(axis=1, keepdims=True)
+        y_next = y[:, stop:next_stop].mean(axis=1, keepdims=True)
+        # Areas (times 2) of the triangles formed with the previously kept point
+        x_previous = x[rows, indices[:, i], np.newaxis]
+        y_previous = y[rows, indices[:, i], np.newaxis]
+        areas = np.abs(
+            (x_previous - x_next) * (y[:, start:stop] - y_previous)
+            - (x_previous - x[:, start:stop]) * (y_next - y_previous)
+        )
+        indices[:, i + 1] = start + np.argmax(areas, axis=1)
+
+    x_downsampled = np.take_along_axis(x, indices, axis=1)
+    y_downsampled = np.take_along_axis(y, indices, axis=1)
+    if is_1d:
+        return x_downsampled[0], y_downsampled[0]
+    return x_downsampled, y_downsampled
+
+
+def round_significant(values: FloatArray, num_digits: int = 5) -> FloatArray:
+    """Round values to a number of significant digits relative to their largest magnitude, which
+    keeps the serialized numbers (and thereby the size of the rendered HTML) short."""
+    magnitude = np.nanmax(np.abs(values), initial=0)
+    if magnitude == 0 or not np.isfinite(magnitude):
+        return values
+    decimals = num_digits - 1 - int(np.floor(np.log10(magnitude)))
+    return np.round(values, decimals)
+
+
+def _to_rgba(color: str, alpha: float) -> str:
+    import matplotlib.colors as mcolors
+
+    r, g, b = (int(255 * c) for c in mcolors.to_rgb(color))
+    return f"rgba({r}, {g}, {b}, {alpha})"
+
+
+def plot_spectra(
+    spectra: list,
+    dataframe: pd.DataFrame,
+    color_by: tuple[str, ...] = ("instrument", "λ_nm"),
+    max_points: int = 300,
+    webgl_threshold: int = 50,
+    figure: "go.Figure | None" = None,
+    **kwargs,
+) -> "go.Figure":
+    """Plot many spectra while keeping the figure small and responsive.
+
+    Each spectrum is downsampled with LTTB to at most `max_points` points. Above
+    `webgl_threshold` spectra, WebGL traces (`go.Scattergl`) are used instead of SVG traces, and
+    the spectra of each group are merged into a single trace (separated by gaps), since the
+    browser slows down with the number of traces rather than the number of points. Spectra are
+    colored and grouped in the legend by the columns in `color_by`, using the colors of
+    `get_custom_colorpalette`.
+
+    The size of the figure still grows with the number of spectra times `max_points`, e.g. about
+    10 MB of HTML for 2400 spectra with the defaults. To summarize many spectra in a small figure,
+    use `plot_spectra_bands` instead, whose size does not depend on the number of spectra.
+
+    Args:
+        spectra:
+            `RamanSpectrum` objects to plot.
+        dataframe:
+            Info corresponding to each spectrum, e.g. as returned by `load_chlamy_spectra`.
+        color_by:
+            Columns of `dataframe` that make up the keys of the color palette, i.e.
+            ("instrument", "λ_nm") or ("strain", "medium").
+        max_points:
+            Maximum number of points per spectrum.
+        webgl_threshold:
+            Number of spectra above which to switch to WebGL traces.
+        figure:
+            Figure to which to add the traces. A new figure is created if not provided.
+        **kwargs:
+            Passed on to each trace, e.g. `opacity` or `line_width`.
+    """
+    import plotly.graph_objects as go
+
+    # Only the first trace of each group is shown in the legend, unless the legend is disabled
+    showlegend = kwargs.pop("showlegend", True)
+    if figure is None:
+        figure = go.Figure(layout=get_default_plotly_layout())
+    color_palette = get_custom_colorpalette()
+    use_webgl = len(spectra) > webgl_threshold
+
+    traces = []
+    for key, group in dataframe.reset_index(drop=True).groupby(list(color_by), sort=False):
+        name = " ".join(str(value) for value in key)
+        group_spectra = [spectra[i] for i in group.index]
+
+        # Downsample all spectra of the same length at once
+        lines = []
+        lengths = [spectrum.wavenumbers_cm1.size for spectrum in group_spectra]
+        for length in dict.fromkeys(lengths):
+            same_length = [s for s, n in zip(group_spectra, lengths, strict=True) if n == length]
+            x, y = lttb_downsample(
+                np.stack([spectrum.wavenumbers_cm1 for spectrum in same_length]),
+                np.stack([spectrum.intensities for spectrum in same_length]),
+                max_points,
+            )
+            lines.extend(zip(round_significant(x, 6), round_significant(y), strict=True))
+
+        trace = {
+            "mode": "lines",
+            "name": name,
+            "legendgroup": name,
+            "line_color": color_palette.get(key),
+            **kwargs,
+        }
+        if use_webgl:
+            # Merge the spectra into a single trace, with a gap (NaN) between spectra
+            gap = np.array([np.nan])
+            x = np.concatenate([np.concatenate([line_x, gap]) for line_x, _line_y in lines])
+            y = np.concatenate([np.concatenate([line_y, gap]) for _line_x, line_y in lines])
+            traces.append(go.Scattergl(x=x, y=y, connectgaps=False, showlegend=showlegend, **trace))
+        else:
+            for i, (x, y) in enumerate(lines):
+                traces.append(go.Scatter(x=x, y=y, showlegend=showlegend and i == 0, **trace))
+
+    figure.add_traces(traces)
+    return figure
+
+
+def plot_spectra_bands(
+    spectra: list,
+    dataframe: pd.DataFrame,
+    color_by: tuple[str, ...] = ("instrument", "λ_nm"),
+    num_points: int = 1000,
+    alpha: float = 0.3,
+    figure: "go.Figure | None" = None,
+) -> "go.Figure":
+    """Plot the mean ± standard deviation of the spectra of each group.
+
+    The spectra of each group (as defined by the columns in `color_by`) are interpolated onto a
+    common wavenumber axis of `num_points` points spanning the range shared by all spectra of the
+    group, such that each group takes up only 3 traces regardless of its number of spectra.
+
+    Args:
+        spectra:
+            `RamanSpectrum` objects to plot.
+        dataframe:
+            Info corresponding to each spectrum, e.g. as returned by `load_chlamy_spectra`.
+        color_by:
+            Columns of `dataframe` that make up the keys of the color palette, i.e.
+            ("instrument", "λ_nm") or ("strain", "medium").
+        num_points:
+            Number of points of the common wavenumber axis of each group.
+        alpha:
+            Opacity of the standard deviation band.
+        figure:
+            Figure to which to add the traces. A new figure is created if not provided.
+    """
+    import arcadia_pycolor as apc
+    import plotly.graph_objects as go
+
+    if figure is None:
+        figure = go.Figure(layout=get_default_plotly_layout())
+    color_palette = get_custom_colorpalette()
+
+    for key, group in dataframe.reset_index(drop=True).groupby(list(color_by), sort=False):
+        group_spectra = [spectra[i] for i in group.index]
+        wavenumber_min = max(spectrum.wavenumbers_cm1.min() for spectrum in group_spectra)
+        wavenumber_max = min(spectrum.wavenumbers_cm1.max() for spectrum in group_spectra)
+        wavenumbers_cm1 = np.linspace(wavenumber_min, wavenumber_max, num_points)
+
+        intensities = np.empty((len(group_spectra), num_points))
+        for i, spectrum in enumerate(group_spectra):
+            order = np.argsort(spectrum.wavenumbers_cm1)
+            intensities[i] = np.interp(
+                wavenumbers_cm1,
+                spectrum.wavenumbers_cm1[order],
+                spectrum.intensities[order],
+            )
+        mean = intensities.mean(axis=0)
+        std = intensities.std(axis=0)
+
+        name = " ".join(str(value) for value in key)
+        color = color_palette.get(key, apc.black.hex_code)
+        band = {
+            "mode": "lines",
+            "line_width": 0,
+            "legendgroup": name,
+            "showlegend": False,
+            "hoverinfo": "skip",
+        }
+        figure.add_trace(go.Scatter(x=wavenumbers_cm1, y=mean - std, **band))
+        figure.add_trace(
+            go.Scatter(
+                x=wavenumbers_cm1,
+                y=mean + std,
+                fill="tonexty",
+                fillcolor=_to_rgba(color, alpha),
+                **band,
+            )
+        )
+        figure.add_trace(
+            go.Scatter(
+                x=wavenumbers_cm1,
+                y=mean,
+                mode="lines",
+                name=f"{name} (n={len(group_spectra)})",
+                legendgroup=name,
+                line_color=color,
+            )
+        )
+    return figure
@@ -0,0 +1,181 @@
+"""
+# Loader profiling
+
+Opt-in instrumentation of the loaders in `analysis.load_spectra`, recording how long each stage
+of each loader call takes (opening tar files, extracting members, writing temporary files,
+parsing, calibrating) along with the number of bytes it handled. Profiling is disabled by default,
+in which case the instrumentation amounts to a flag check per stage. It is enabled either with
+`enable_profiling()`, or for whole scripts by setting the environment variable
+`ANALYSIS_PROFILING=1`.
+
+Records are kept in memory by the process that made them: those of worker processes (e.g. of a
+`multiprocessing` pool) are not collected, so profile loaders in the main process.
+
+## Usage
+>>> from analysis import profiling
+>>> from analysis.load_spectra import load_chlamy_spectra
+>>> profiling.enable_profiling()
+>>> spectra, dataframe = load_chlamy_spectra()
+>>> profiling.get_profile(summary=True)
+    | call                | instrument | λ_nm | stage       | count | duration_s | MB_per_s |
+    |---------------------|------------|------|-------------|-------|------------|----------|
+    | load_chlamy_spectra | openraman  |  532 | calibration |  6000 |      3.470 |    75.62 |
+    | load_chlamy_spectra | openraman  |  532 | extract     |  6002 |      0.966 |   271.86 |
+    ...
+"""
+
+import contextvars
+import functools
+import itertools
+import os
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+import pandas as pd
+
+# Columns that every record has, in the order in which they are shown
+PROFILE_COLUMNS = ["call_id", "call", "stage", "start_s", "duration_s", "nbytes"]
+
+_enabled = os.environ.get("ANALYSIS_PROFILING", "") not in ("", "0")
+_records = []
+_records_lock = threading.Lock()
+_call_ids = itertools.count()
+_origin = time.perf_counter()
+# Name, id, and any extra info (e.g. the instrument) of the loader call that is running
+_current_call = contextvars.ContextVar("current_call", default={})
+
+
+def enable_profiling():
+    """Start recording the stages of loader calls."""
+    global _enabled
+    _enabled = True
+
+
+def disable_profiling():
+    """Stop recording the stages of loader calls. Records so far are kept."""
+    global _enabled
+    _enabled = False
+
+
+def is_profiling_enabled() -> bool:
+    return _enabled
+
+
+def reset_profile():
+    """Discard all records so far."""
+    with _records_lock:
+        _records.clear()
+
+
+@contextmanager
+def stage(name: str, nbytes: int = 0, **info) -> Iterator[dict]:
+    """Record the duration of a stage of the running loader call.
+
+    Yields a dict in which the byte count (or any other info) can be filled in once it is known.
+
+    Examples:
+        >>> with stage("extract") as record:
+        ...     buffer = tar.extractfile(member).read()
+        ...     record["nbytes"] = len(buffer)
+    """
+    if not _enabled:
+        yield {}
+        return
+
+    record = {"nbytes": nbytes, **info}
+    start_time = time.perf_counter()
+    try:
+        yield record
+    finally:
+        end_time = time.perf_counter()
+        record = {
+            **_current_call.get(),
+            "stage": name,
+            "start_s": start_time - _origin,
+            "duration_s": end_time - start_time,
+            **record,
+        }
+        with _records_lock:
+            _records.append(record)
+
+
+@contextmanager
+def profile_info(**info) -> Iterator[None]:
+    """Attach extra info (e.g. the instrument) to the records of stages run within."""
+    if not _enabled:
+        yield
+        return
+    token = _current_call.set({**_current_call.get(), **info})
+    try:
+        yield
+    finally:
+        _current_call.reset(token)
+
+
+def profiled(function: Callable) -> Callable:
+    """Decorator that records each call of a loader, under which its stages are grouped, along
+    with its total duration as the "total" stage."""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return function(*args, **kwargs)
+        call = {**_current_call.get(), "call_id": next(_call_ids), "call": function.__name__}
+        token = _current_call.set(call)
+        try:
+            with stage("total"):
+                return function(*args, **kwargs)
+        finally:
+            _current_call.reset(token)
+
+    return wrapper
+
+
+def profile_read(function: Callable, *filepaths: str | Path, stage_name: str = "parse", **kwargs):
+    """Call a reader (e.g. `RamanSpectrum.from_horiba_txtfile`) on files as a stage, counting
+    the size of the files as its number of bytes."""
+    if not _enabled:
+        return function(*filepaths, **kwargs)
+    nbytes = sum(os.path.getsize(filepath) for filepath in filepaths)
+    with stage(stage_name, nbytes=nbytes, filename=Path(filepaths[0]).name):
+        return function(*filepaths, **kwargs)
+
+
+def get_profile(summary: bool = False) -> pd.DataFrame:
+    """Get the records so far as a DataFrame.
+
+    Args:
+        summary:
+            Sum the duration and number of bytes of each stage per loader call (and instrument,
+            if recorded), rather than returning one row per stage.
+
+    Returns:
+        profile:
+            One row per recorded stage, or per (call, [instrument, λ_nm], stage) if `summary`.
+    """
+    with _records_lock:
+        profile = pd.DataFrame(list(_records))
+    if profile.empty:
+        profile = pd.DataFrame(columns=PROFILE_COLUMNS)
+    extra_columns = [column for column in profile.columns if column not in PROFILE_COLUMNS]
+    # Stages run outside of a loader call have no call id or name
+    profile = profile.reindex(columns=PROFILE_COLUMNS + extra_columns)
+    if not summary:
+        return profile
+
+    keys = ["call", *[key for key in ("instrument", "λ_nm") if key in profile], "stage"]
+    summary_profile = (
+        profile.groupby(keys, dropna=False)
+        .agg(
+            count=("duration_s", "size"),
+            duration_s=("duration_s", "sum"),
+            nbytes=("nbytes", "sum"),
+        )
+        .reset_index()
+    )
+    throughput = summary_profile["nbytes"] / summary_profile["duration_s"] / 1e6
+    summary_profile["MB_per_s"] = throughput.where(summary_profile["nbytes"] > 0)
+    return summary_profile
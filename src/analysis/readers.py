@@ -0,0 +1,384 @@
+"""
+# Fast spectrum file readers
+
+This module parses the spectrum files of each instrument straight from in-memory buffers. The
+format of each file is detected from its first bytes, so that no reader has to be selected by
+hand, and the numeric blocks of many files of the same format are concatenated and parsed in a
+single pass by the C engine of `pandas.read_csv`, which is where most of the time goes when
+loading thousands of small files.
+
+The supported formats are
+- "horiba": Horiba LabSpec txt files (`#Acq. time` header, tab-separated wavenumber/intensity),
+- "renishaw": Renishaw WiRE txt files of a single spectrum (`#Wave  #Intensity`),
+- "renishaw_multipoint": Renishaw WiRE txt files of a multipoint scan (`#X  #Y  #Wave
+  #Intensity`),
+- "wasatch": Wasatch ENLIGHTEN csv files (`ENLIGHTEN Version` header),
+- "pixel_csv": two-column csv files (`Pixel,Intensity`), as written by the OpenRAMAN and by
+  Wasatch ENLIGHTEN when exporting a single column. Note that the first column holds detector
+  pixels for the OpenRAMAN, which still need to be calibrated with
+  `RamanSpectrum.from_openraman_csvfiles`.
+
+Each file is parsed into a tuple of `(wavenumbers_cm1, intensities, positions)`, mirroring
+`ramanalysis.readers.read_renishaw_multipoint_txt`, in which `intensities` always has shape
+(num_spectra, num_wavenumbers) and `positions` is None for anything other than multipoint scans.
+
+## Usage
+>>> from analysis.readers import iter_tar_members, parse_buffers, to_raman_spectra
+>>> members = list(iter_tar_members("data/Renishaw_Qontor/chlamy_spectra.tar", "*_cells*.txt"))
+>>> parsed = parse_buffers([buffer for _name, buffer in members])
+>>> spectra = [spectrum for result in parsed for spectrum in to_raman_spectra(result)]
+
+Since these readers stand in for those of `ramanalysis` in `load_chlamy_spectra`, check that both
+still agree on the bundled files (e.g. after upgrading either) with
+
+    python -m analysis.readers
+"""
+
+import argparse
+import io
+import re
+import tarfile
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from numpy.typing import NDArray
+from ramanalysis import RamanSpectrum
+from ramanalysis.readers import read_renishaw_multipoint_txt
+
+from .profiling import stage
+
+FloatArray = NDArray[np.float64]
+ParsedSpectra = tuple[FloatArray, FloatArray, FloatArray | None]
+
+# Number of bytes at the start of a file in which to look for a format signature
+SNIFF_SIZE = 1024
+
+# Byte signatures by which each format is recognized, in order of precedence
+FORMAT_SIGNATURES = {
+    "horiba": re.compile(rb"^#Acq\. time"),
+    "wasatch": re.compile(rb"^ENLIGHTEN Version"),
+    "pixel_csv": re.compile(rb"^Pixels? ?#?,Intensity"),
+    "renishaw_multipoint": re.compile(rb"^#X\s+#Y\s+#Wave"),
+    "renishaw": re.compile(rb"^#Wave"),
+}
+
+# Delimiter and number of columns of the numeric block of each format
+FORMAT_COLUMNS = {
+    "horiba": ("\t", 2),
+    "wasatch": (",", 4),
+    "pixel_csv": (",", 2),
+    "renishaw_multipoint": ("\t", 4),
+    "renishaw": ("\t", 2),
+}
+
+# Bundled files on which to compare these readers to the `ramanalysis` readers, along with the
+# `ramanalysis` reader that `analysis.load_spectra` uses for each of them
+REFERENCE_FILES = {
+    "Horiba_MacroRAM/CC-124-TAP-2.txt": "from_horiba_txtfile",
+    "Horiba_MacroRAM/acetonitrile.txt": "from_horiba_txtfile",
+    "Renishaw_Qontor/CC-124_TAP_plate_5x_3_points.txt": "read_renishaw_multipoint_txt",
+    "Renishaw_Qontor/acetonitrile_5x.txt": "from_renishaw_txtfile",
+    "Wasatch_WP532X/CC-124_TAP_Pos-4-002_001.csv": "from_generic_csvfile",
+    "Wasatch_WP532X/acetonitrile.csv": "from_generic_csvfile",
+    "Wasatch_WP785X/CC-124_TAP_WP-02071.csv": "from_wasatch_csvfile",
+    "Wasatch_WP785X/acetonitrile.csv": "from_wasatch_csvfile",
+}
+
+HORIBA_HEADER = re.compile(rb"(?:#[^\n]*\n)*")
+WASATCH_DATA_HEADER = b"Pixel,Wavelength,Wavenumber,Processed"
+
+
+def sniff_format(buffer: bytes) -> str:
+    """Detect the format of a spectrum file from its first bytes.
+
+    Raises:
+        ValueError: If the buffer does not start with the signature of any supported format.
+    """
+    head = buffer[:SNIFF_SIZE]
+    for file_format, signature in FORMAT_SIGNATURES.items():
+        if signature.match(head):
+            return file_format
+    raise ValueError(f"Unable to detect the file format from its first bytes: {head[:40]!r}")
+
+
+def get_numeric_block(buffer: bytes, file_format: str) -> bytes:
+    """Strip the header of a spectrum file, leaving only the rows of numbers."""
+    if file_format == "horiba":
+        start = HORIBA_HEADER.match(buffer).end()
+    elif file_format == "wasatch":
+        start = buffer.index(b"\n", buffer.index(WASATCH_DATA_HEADER)) + 1
+    else:
+        start = buffer.index(b"\n") + 1
+    # Normalize the end of the block such that each row ends with exactly one newline
+    return buffer[start:].rstrip() + b"\n"
+
+
+def find_point_starts(
+    values: FloatArray,
+    first_wavenumber: float | None = None,
+    previous_position: FloatArray | None = None,
+) -> NDArray[np.bool_]:
+    """Find the rows of a Renishaw multipoint scan at which a new point starts.
+
+    Rows are grouped by point, so a new point starts wherever the position changes, or wherever
+    the wavenumbers restart from the first wavenumber of the scan, as for repeated acquisitions
+    at the same position.
+
+    Args:
+        values:
+            (x, y, wavenumber, intensity) rows of the scan, or of a chunk of it.
+        first_wavenumber:
+            Wavenumber of the first row of the scan. Defaults to that of the first row of
+            `values`.
+        previous_position:
+            (x, y) position of the row before `values`, when parsing the scan in chunks. The
+            first row of `values` starts a new point if not provided.
+
+    Returns:
+        starts:
+            Whether each row starts a new point.
+    """
+    if first_wavenumber is None:
+        first_wavenumber = values[0, 2]
+    xy = values[:, :2]
+    reference = xy[:1] if previous_position is None else np.reshape(previous_position, (1, 2))
+    starts = np.any(np.diff(np.vstack([reference, xy]), axis=0) != 0, axis=1)
+    starts |= values[:, 2] == first_wavenumber
+    if previous_position is None:
+        starts[0] = True
+    return starts
+
+
+def check_point_lengths(starts: NDArray[np.intp], num_rows: int) -> int:
+    """Check that all points of a multipoint scan, starting at rows `starts`, have the same
+    number of rows, and return it.
+
+    Raises:
+        ValueError: If the points of the scan have different numbers of rows.
+    """
+    lengths = np.diff(np.append(starts, num_rows))
+    if np.any(lengths != lengths[0]):
+        raise ValueError("Points of the multipoint scan do not share the same wavenumbers.")
+    return int(lengths[0])
+
+
+def _split_numeric_block(values: FloatArray, file_format: str) -> ParsedSpectra:
+    """Arrange the parsed numeric block of a single file into wavenumbers, intensities, and
+    positions."""
+    if file_format == "wasatch":
+        # Pixels outside of the region of interest are not processed ("NA")
+        values = values[np.isfinite(values[:, 3])]
+        return values[:, 2], values[np.newaxis, :, 3], None
+
+    if file_format == "renishaw_multipoint":
+        starts = np.flatnonzero(find_point_starts(values))
+        num_points = starts.size
+        num_wavenumbers = check_point_lengths(starts, values.shape[0])
+        positions = values[starts, :2]
+        wavenumbers_cm1 = values[:num_wavenumbers, 2]
+        intensities = values[:, 3].reshape(num_points, num_wavenumbers)
+        return wavenumbers_cm1, intensities, positions
+
+    return values[:, 0], values[np.newaxis, :, 1], None
+
+
+def _parse_numeric_blocks(blocks: list[bytes], file_format: str) -> list[FloatArray]:
+    """Parse the numeric blocks of many files of the same format in one `read_csv` call."""
+    delimiter, num_columns = FORMAT_COLUMNS[file_format]
+    values = pd.read_csv(
+        io.BytesIO(b"".join(blocks)),
+        sep=delimiter,
+        header=None,
+        usecols=range(num_columns),
+        dtype=np.float64,
+        engine="c",
+        skip_blank_lines=False,
+    ).to_numpy()
+    row_counts = [block.count(b"\n") for block in blocks]
+    return np.split(values, np.cumsum(row_counts)[:-1])
+
+
+def parse_buffer(buffer: bytes, file_format: str | None = None) -> ParsedSpectra:
+    """Parse a spectrum file from an in-memory buffer.
+
+    Args:
+        buffer:
+            Contents of the file.
+        file_format:
+            Format of the file. Detected from the first bytes of the file if not provided.
+
+    Returns:
+        wavenumbers_cm1:
+            Wavenumbers (or pixels for the OpenRAMAN) of the spectra.
+        intensities:
+            Intensities of shape (num_spectra, num_wavenumbers).
+        positions:
+            (x, y) positions of shape (num_spectra, 2) for multipoint scans, otherwise None.
+    """
+    return parse_buffers([buffer], file_format=file_format)[0]
+
+
+def parse_buffers(
+    buffers: list[bytes],
+    file_format: str | None = None,
+    num_workers: int | None = None,
+) -> list[ParsedSpectra]:
+    """Parse many spectrum files from in-memory buffers.
+
+    Files are grouped by format, and the numeric blocks of each group are parsed together, such
+    that the per-call overhead of the parser is paid once per format rather than once per file.
+
+    Args:
+        buffers:
+            Contents of each file.
+        file_format:
+            Format of all files. Detected for each file from its first bytes if not provided.
+        num_workers:
+            Number of threads among which to divide the files of each format. Parses in the
+            calling thread if not provided.
+
+    Returns:
+        parsed:
+            `(wavenumbers_cm1, intensities, positions)` of each file, in the order of `buffers`.
+    """
+    file_formats = [file_format or sniff_format(buffer) for buffer in buffers]
+
+    parsed = [None] * len(buffers)
+    for group_format in dict.fromkeys(file_formats):
+        indices = [i for i, f in enumerate(file_formats) if f == group_format]
+        nbytes = sum(len(buffers[i]) for i in indices)
+        with stage("parse", nbytes=nbytes, file_format=group_format):
+            blocks = [get_numeric_block(buffers[i], group_format) for i in indices]
+
+            if num_workers is None or num_workers <= 1 or len(blocks) < 2 * num_workers:
+                values = _parse_numeric_blocks(blocks, group_format)
+            else:
+                batch_size = -(-len(blocks) // num_workers)
+                batches = [blocks[i : i + batch_size] for i in range(0, len(blocks), batch_size)]
+                with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                    results = executor.map(
+                        _parse_numeric_blocks, batches, [group_format] * len(batches)
+                    )
+                values = [block_values for result in results for block_values in result]
+
+            for i, block_values in zip(indices, values, strict=True):
+                parsed[i] = _split_numeric_block(block_values, group_format)
+    return parsed
+
+
+def read_files(
+    filepaths: list[str | Path],
+    file_format: str | None = None,
+    num_workers: int | None = None,
+) -> list[ParsedSpectra]:
+    """Read and parse many spectrum files at once. See `parse_buffers`."""
+    buffers = [Path(filepath).read_bytes() for filepath in filepaths]
+    return parse_buffers(buffers, file_format=file_format, num_workers=num_workers)
+
+
+def iter_tar_members(tarpath: str | Path, pattern: str = "*") -> Iterator[tuple[str, bytes]]:
+    """Iterate over the names and contents of the files in a tar file that match a pattern.
+
+    The tar file is opened and read through only once, and the contents of each member are read
+    into memory rather than extracted to temporary files.
+    """
+    with stage("tar_open", filename=Path(tarpath).name):
+        tar = tarfile.open(tarpath, "r")
+    with tar:
+        for member in tar:
+            if member.isfile() and fnmatch(member.name, pattern):
+                # The record is closed before yielding, such that only the extraction is timed
+                with stage("extract", nbytes=member.size):
+                    buffer = tar.extractfile(member).read()
+                yield member.name, buffer
+            # Members that have been read are not needed anymore, which matters for big archives
+            tar.members.clear()
+
+
+def to_raman_spectra(parsed: ParsedSpectra) -> list[RamanSpectrum]:
+    """Convert the output of `parse_buffer` into a `RamanSpectrum` for each spectrum."""
+    wavenumbers_cm1, intensities, _positions = parsed
+    return [
+        RamanSpectrum(wavenumbers_cm1, spectrum_intensities) for spectrum_intensities in intensities
+    ]
+
+
+def is_pixel_axis(wavenumbers_cm1: FloatArray) -> bool:
+    """Whether the first column of a parsed file holds detector pixels (0, 1, 2, ...) rather than
+    wavenumbers, as in the "pixel_csv" files of the OpenRAMAN that have yet to be calibrated."""
+    return np.array_equal(wavenumbers_cm1, np.arange(np.size(wavenumbers_cm1)))
+
+
+def _read_with_ramanalysis(filepath: Path, reader: str) -> ParsedSpectra:
+    """Read a file with a `ramanalysis` reader into the output format of `parse_buffer`."""
+    if reader == "read_renishaw_multipoint_txt":
+        wavenumbers_cm1, intensities, positions = read_renishaw_multipoint_txt(filepath)
+        return np.asarray(wavenumbers_cm1), np.asarray(intensities), np.asarray(positions)
+    spectrum = getattr(RamanSpectrum, reader)(filepath)
+    return np.asarray(spectrum.wavenumbers_cm1), np.atleast_2d(spectrum.intensities), None
+
+
+def compare_with_ramanalysis(
+    data_directory: str | Path,
+    filenames: dict[str, str] | None = None,
+    rtol: float = 1e-9,
+) -> pd.DataFrame:
+    """Compare the output of `parse_buffer` to that of the `ramanalysis` readers.
+
+    Args:
+        data_directory:
+            Data directory of this repository.
+        filenames:
+            Paths of the files to compare (relative to `data_directory`), mapped to the name of
+            the `ramanalysis` reader to compare to. Defaults to `REFERENCE_FILES`.
+        rtol:
+            Relative tolerance of the comparison of wavenumbers, intensities, and positions.
+
+    Returns:
+        comparison:
+            Shape of the intensities from either reader and whether they match, for each file.
+    """
+    rows = []
+    for filename, reader in (filenames or REFERENCE_FILES).items():
+        filepath = Path(data_directory) / filename
+        expected = _read_with_ramanalysis(filepath, reader)
+        parsed = parse_buffer(filepath.read_bytes())
+
+        matches = parsed[1].shape == expected[1].shape
+        for values, expected_values in zip(parsed, expected, strict=True):
+            if not matches or values is None or expected_values is None:
+                continue
+            matches = np.allclose(values, expected_values, rtol=rtol, atol=0, equal_nan=True)
+        rows.append(
+            {
+                "file": filename,
+                "reader": reader,
+                "shape": parsed[1].shape,
+                "expected_shape": expected[1].shape,
+                "matches": matches,
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def main():
+    from .load_spectra import DATA_DIRECTORY
+
+    parser = argparse.ArgumentParser(
+        description="Check that these readers agree with the ramanalysis readers."
+    )
+    parser.add_argument("--data-directory", type=Path, default=DATA_DIRECTORY)
+    args = parser.parse_args()
+
+    comparison = compare_with_ramanalysis(args.data_directory)
+    print(comparison.to_string(index=False))
+    if not comparison["matches"].all():
+        raise SystemExit("Readers disagree with ramanalysis on some of the files.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+# Spectral resampling
+
+Spectra of different instruments (and OpenRAMAN spectra after calibration) are sampled at
+different wavenumbers, so they are interpolated onto a common wavenumber axis before they can be
+arranged into a feature matrix. This module only depends on NumPy, such that loading and
+resampling spectra does not pull in scikit-learn.
+
+## Usage
+>>> from analysis.resampling import resample_spectra
+>>> wavenumbers_cm1 = np.arange(400, 1800, 1.0)
+>>> X = resample_spectra(spectra, wavenumbers_cm1)
+"""
+
+import numpy as np
+from numpy.typing import NDArray
+
+FloatArray = NDArray[np.float64]
+
+
+def get_interpolation_weights(
+    x: FloatArray,
+    xp: FloatArray,
+) -> tuple[NDArray[np.intp], FloatArray]:
+    """Indices and weights for linearly interpolating values sampled at (ascending) `xp` at `x`,
+    such that `(1 - w) * f[i - 1] + w * f[i]` equals `np.interp(x, xp, f)`."""
+    indices = np.clip(np.searchsorted(xp, x), 1, xp.size - 1)
+    weights = (x - xp[indices - 1]) / (xp[indices] - xp[indices - 1])
+    return indices, np.clip(weights, 0, 1)
+
+
+def resample_spectra(spectra: list, wavenumbers_cm1: FloatArray) -> FloatArray:
+    """Interpolate spectra onto a common wavenumber axis, arranging them into a feature matrix.
+
+    Spectra that share the same wavenumber axis (e.g. all spectra of an instrument) are
+    interpolated together as a single matrix operation.
+
+    Args:
+        spectra:
+            `RamanSpectrum` objects to resample.
+        wavenumbers_cm1:
+            Common wavenumber axis onto which to interpolate.
+
+    Returns:
+        X:
+            Intensities of shape (num_spectra, num_wavenumbers).
+    """
+    wavenumbers_cm1 = np.asarray(wavenumbers_cm1, dtype=float)
+    X = np.empty((len(spectra), wavenumbers_cm1.size))
+
+    # Group spectra by wavenumber axis
+    groups = {}
+    for i, spectrum in enumerate(spectra):
+        axis = np.asarray(spectrum.wavenumbers_cm1, dtype=float)
+        groups.setdefault((axis.size, axis.tobytes()), (axis, []))[1].append(i)
+
+    for axis, indices in groups.values():
+        intensities = np.stack([spectra[i].intensities for i in indices])
+        X[indices] = resample_matrix(intensities, axis, wavenumbers_cm1)
+    return X
+
+
+def resample_matrix(
+    X: FloatArray,
+    wavenumbers_cm1: FloatArray,
+    new_wavenumbers_cm1: FloatArray,
+) -> FloatArray:
+    """Interpolate the rows of a matrix of spectra sharing one wavenumber axis onto another.
+
+    Args:
+        X:
+            Intensities of shape (num_spectra, num_wavenumbers).
+        wavenumbers_cm1:
+            Wavenumber axis of the columns of `X`.
+        new_wavenumbers_cm1:
+            Wavenumber axis onto which to interpolate.
+    """
+    wavenumbers_cm1 = np.asarray(wavenumbers_cm1, dtype=float)
+    order = np.argsort(wavenumbers_cm1)
+    X = np.asarray(X)[:, order]
+    columns, weights = get_interpolation_weights(
+        np.asarray(new_wavenumbers_cm1, dtype=float), wavenumbers_cm1[order]
+    )
+    return (1 - weights) * X[:, columns - 1] + weights * X[:, columns]
@@ -0,0 +1,486 @@
+"""
+# Local inference service
+
+This module serves predictions of a fitted classification pipeline (e.g. from
+`BatchClassifier.models`) over HTTP on localhost, so that new spectra can be classified without
+re-running the notebook. The model is loaded once when the service starts, and requests are
+gathered into micro-batches such that the pipeline is called once for many spectra.
+
+## Usage
+Save a fitted pipeline along with the wavenumber axis its features were resampled onto
+>>> from analysis.serve import save_model
+>>> save_model("model.joblib", batch_classifier.models["LogisticRegression"], wavenumbers_cm1)
+
+start the service
+
+    python -m analysis.serve model.joblib --port 8000
+
+and send it spectrum files (any format supported by `analysis.readers`) or tar archives of them
+
+    curl --data-binary @CC-124_TAP_WP-02071.csv http://127.0.0.1:8000/predict
+    curl --data-binary @chlamy_spectra.tar http://127.0.0.1:8000/predict
+    curl http://127.0.0.1:8000/metrics
+
+Tar archives laid out like the bundled `chlamy_spectra.tar` files are read like
+`load_chlamy_spectra` reads them: only the members matching `CHLAMY_SPECTRA_PATTERNS` are
+classified. The predictions of each spectrum are reported along with its file and its index
+within that file (e.g. the point of a multipoint scan).
+
+OpenRAMAN spectra (whose first column holds detector pixels rather than wavenumbers) are
+calibrated with `load_openraman_buffers`, using the neon and acetonitrile calibration files of the
+archive (`OPENRAMAN_CALIBRATION_FILENAMES`), which are never classified themselves, or otherwise
+those that were saved along with the model
+>>> save_model(
+...     "model.joblib",
+...     pipeline,
+...     wavenumbers_cm1,
+...     openraman_calibration_filepaths=["neon_4x.csv", "acetonitrile_4x.csv"],
+... )
+
+Requests with OpenRAMAN spectra are rejected (HTTP 400) by models saved without them.
+"""
+
+import argparse
+import io
+import json
+import queue
+import tarfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from fnmatch import fnmatch
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import joblib
+import numpy as np
+import pandas as pd
+from numpy.typing import NDArray
+
+from .load_spectra import (
+    CHLAMY_SPECTRA_PATTERNS,
+    OPENRAMAN_CALIBRATION_FILENAMES,
+    load_openraman_buffers,
+)
+from .readers import is_pixel_axis, parse_buffers, sniff_format, to_raman_spectra
+from .resampling import resample_spectra
+
+FloatArray = NDArray[np.float64]
+
+
+def save_model(
+    filepath: str | Path,
+    pipeline,
+    wavenumbers_cm1: FloatArray,
+    metadata: dict | None = None,
+    openraman_calibration_filepaths: list[str | Path] | None = None,
+):
+    """Serialize a fitted pipeline along with the wavenumber axis of its features.
+
+    Args:
+        filepath:
+            Path of the file to write.
+        pipeline:
+            Fitted pipeline (or classifier) with a `predict` method.
+        wavenumbers_cm1:
+            Wavenumber axis onto which spectra were resampled to train the pipeline.
+        metadata:
+            Any additional info to store alongside the model, e.g. the instrument.
+        openraman_calibration_filepaths:
+            Neon and acetonitrile calibration files (in that order) with which to calibrate
+            OpenRAMAN spectra sent to the service. OpenRAMAN spectra are rejected if not provided.
+    """
+    bundle = {
+        "pipeline": pipeline,
+        "wavenumbers_cm1": np.asarray(wavenumbers_cm1, dtype=float),
+        "metadata": metadata or {},
+        "openraman_calibration_buffers": [
+            Path(filepath).read_bytes() for filepath in openraman_calibration_filepaths or []
+        ],
+    }
+    joblib.dump(bundle, filepath)
+
+
+def load_model(filepath: str | Path) -> dict:
+    """Load a pipeline serialized with `save_model`."""
+    return joblib.load(filepath)
+
+
+def _read_tar_members(buffer: bytes) -> tuple[list[str], list[bytes], list[bytes]]:
+    """Read the spectrum files and the OpenRAMAN calibration files of a tar archive.
+
+    Members whose format is not recognized (e.g. macOS `._*` files) are skipped, and so are
+    members that do not match `CHLAMY_SPECTRA_PATTERNS` if any member does.
+    """
+    names, buffers = [], []
+    calibration_buffers = dict.fromkeys(OPENRAMAN_CALIBRATION_FILENAMES)
+    with tarfile.open(fileobj=io.BytesIO(buffer), mode="r") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            member_buffer = tar.extractfile(member).read()
+            if member.name in calibration_buffers:
+                calibration_buffers[member.name] = member_buffer
+                continue
+            try:
+                sniff_format(member_buffer)
+            except ValueError:
+                continue
+            names.append(member.name)
+            buffers.append(member_buffer)
+
+    is_spectrum = [
+        any(fnmatch(name, pattern) for pattern in CHLAMY_SPECTRA_PATTERNS.values())
+        for name in names
+    ]
+    if any(is_spectrum):
+        names = [name for name, flag in zip(names, is_spectrum, strict=True) if flag]
+        buffers = [buffer for buffer, flag in zip(buffers, is_spectrum, strict=True) if flag]
+    # Calibration files are only used if the archive holds both of them
+    if None in calibration_buffers.values():
+        return names, buffers, []
+    return names, buffers, list(calibration_buffers.values())
+
+
+def read_request_body(
+    buffer: bytes,
+    filename: str = "",
+    calibration_buffers: list[bytes] | None = None,
+) -> tuple[list[str], list[int], list]:
+    """Parse the spectra of a single spectrum file or of a tar archive of spectrum files.
+
+    Members of tar archives whose format is not recognized (e.g. macOS `._*` files) are skipped,
+    as are members that do not match `CHLAMY_SPECTRA_PATTERNS` in archives laid out like the
+    bundled ones. OpenRAMAN spectra are calibrated with `load_openraman_buffers`, using the
+    calibration files of the archive (`OPENRAMAN_CALIBRATION_FILENAMES`) if it holds them.
+
+    Args:
+        buffer:
+            Contents of the spectrum file or tar archive.
+        filename:
+            Name of the spectrum file, reported along with its spectra.
+        calibration_buffers:
+            Contents of the neon and acetonitrile calibration files of the OpenRAMAN, used for
+            archives without calibration files of their own.
+
+    Raises:
+        ValueError: If there are OpenRAMAN spectra but no calibration files.
+
+    Returns:
+        filenames:
+            Name of the file of each spectrum.
+        indices:
+            Index of each spectrum within its file, e.g. the point of a multipoint scan.
+        spectra:
+            `RamanSpectrum` object of each spectrum.
+    """
+    if len(buffer) > 262 and buffer[257:262] == b"ustar":
+        names, buffers, archive_calibration_buffers = _read_tar_members(buffer)
+        calibration_buffers = archive_calibration_buffers or calibration_buffers
+    else:
+        names, buffers = [filename], [buffer]
+
+    parsed = parse_buffers(buffers)
+    # Detector pixels rather than wavenumbers, i.e. OpenRAMAN spectra that need calibrating
+    needs_calibration = [is_pixel_axis(wavenumbers_cm1) for wavenumbers_cm1, *_ in parsed]
+    calibrated = []
+    if any(needs_calibration):
+        if not calibration_buffers:
+            raise ValueError(
+                "OpenRAMAN spectra (with detector pixels rather than wavenumbers) cannot be "
+                "calibrated, as neither the request nor the model holds calibration files."
+            )
+        calibrated = load_openraman_buffers(
+            [buffer for buffer, flag in zip(buffers, needs_calibration, strict=True) if flag],
+            calibration_buffers,
+        )
+    calibrated = iter(calibrated)
+
+    filenames = []
+    indices = []
+    spectra = []
+    for name, result, flag in zip(names, parsed, needs_calibration, strict=True):
+        file_spectra = [next(calibrated)] if flag else to_raman_spectra(result)
+        filenames.extend([name] * len(file_spectra))
+        indices.extend(range(len(file_spectra)))
+        spectra.extend(file_spectra)
+    return filenames, indices, spectra
+
+
+class ServiceMetrics:
+    """Thread-safe counters of the throughput and latency of the service."""
+
+    def __init__(self, window_size: int = 10_000):
+        self.started_at = time.time()
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_spectra = 0
+        self.num_batches = 0
+        self.latencies_ms = deque(maxlen=window_size)
+        self.batch_sizes = deque(maxlen=window_size)
+        self._lock = threading.Lock()
+
+    def record_request(self, num_spectra: int, latency_ms: float):
+        with self._lock:
+            self.num_requests += 1
+            self.num_spectra += num_spectra
+            self.latencies_ms.append(latency_ms)
+
+    def record_error(self):
+        with self._lock:
+            self.num_errors += 1
+
+    def record_batch(self, batch_size: int):
+        with self._lock:
+            self.num_batches += 1
+            self.batch_sizes.append(batch_size)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            uptime_s = time.time() - self.started_at
+            latencies_ms = np.array(self.latencies_ms)
+            percentiles = (
+                np.percentile(latencies_ms, [50, 95, 99]) if latencies_ms.size else [np.nan] * 3
+            )
+            return {
+                "uptime_s": uptime_s,
+                "num_requests": self.num_requests,
+                "num_errors": self.num_errors,
+                "num_spectra": self.num_spectra,
+                "num_batches": self.num_batches,
+                "mean_batch_size": float(np.mean(self.batch_sizes)) if self.batch_sizes else None,
+                "spectra_per_s": self.num_spectra / uptime_s,
+                "requests_per_s": self.num_requests / uptime_s,
+                "latency_p50_ms": float(percentiles[0]),
+                "latency_p95_ms": float(percentiles[1]),
+                "latency_p99_ms": float(percentiles[2]),
+            }
+
+
+class PredictionService:
+    """Long-lived predictor that gathers concurrent requests into micro-batches.
+
+    Attributes:
+        model_filepath : str | Path
+            Path of a model saved with `save_model`.
+        max_batch_size : int, optional (default=256)
+            Maximum number of spectra to pass to the pipeline at once.
+        max_wait_ms : float, optional (default=5.0)
+            Maximum time to wait for more requests before running a batch.
+        timeout_s : float, optional (default=60.0)
+            Maximum time to wait for the predictions of a request.
+
+    Examples:
+        >>> service = PredictionService("model.joblib")
+        >>> service.predict(Path("CC-124_TAP_WP-02071.csv").read_bytes())
+        [{'file': '', 'index': 0, 'prediction': 'CC-124_TAP'}]
+        >>> service.close()
+    """
+
+    def __init__(
+        self,
+        model_filepath: str | Path,
+        max_batch_size: int = 256,
+        max_wait_ms: float = 5.0,
+        timeout_s: float = 60.0,
+    ):
+        bundle = load_model(model_filepath)
+        self.pipeline = bundle["pipeline"]
+        self.wavenumbers_cm1 = bundle["wavenumbers_cm1"]
+        self.metadata = bundle["metadata"]
+        # Models saved before calibration files were stored along with them have none
+        self.calibration_buffers = bundle.get("openraman_calibration_buffers", [])
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.timeout_s = timeout_s
+        self.metrics = ServiceMetrics()
+
+        self._closed = False
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run_batches, daemon=True)
+        self._worker.start()
+
+    def predict(self, buffer: bytes, filename: str = "") -> list[dict]:
+        """Predict the class of each spectrum in a spectrum file or tar archive.
+
+        Raises:
+            ValueError: If the request holds no spectra, or spectra that cannot be calibrated.
+            RuntimeError: If the service is closed, or the predictions are not ready in time.
+        """
+        start_time = time.perf_counter()
+        try:
+            if self._closed or not self._worker.is_alive():
+                raise RuntimeError("The prediction service is closed.")
+            filenames, indices, spectra = read_request_body(
+                buffer, filename, self.calibration_buffers
+            )
+            if not spectra:
+                raise ValueError("No spectra found in the request.")
+            X = resample_spectra(spectra, self.wavenumbers_cm1)
+            future = Future()
+            self._queue.put((X, future))
+            try:
+                labels = future.result(timeout=self.timeout_s)
+            except FutureTimeoutError as error:
+                raise RuntimeError(
+                    f"Predictions were not ready within {self.timeout_s} s."
+                ) from error
+        except Exception:
+            self.metrics.record_error()
+            raise
+
+        latency_ms = 1e3 * (time.perf_counter() - start_time)
+        self.metrics.record_request(len(spectra), latency_ms)
+        return [
+            {"file": name, "index": index, "prediction": label}
+            for name, index, label in zip(filenames, indices, labels, strict=True)
+        ]
+
+    def _run_batches(self):
+        """Run the pipeline on batches of queued requests until the service is closed."""
+        while (item := self._queue.get()) is not None:
+            items = [item]
+            num_spectra = item[0].shape[0]
+            deadline = time.perf_counter() + self.max_wait_ms / 1e3
+            # Gather more requests until the batch is full or the deadline has passed
+            while num_spectra < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                items.append(item)
+                num_spectra += item[0].shape[0]
+
+            # Features are passed as a DataFrame, as in `BatchClassifier.fit`
+            X = pd.DataFrame(np.concatenate([X for X, _future in items]))
+            try:
+                labels = self.pipeline.predict(X).tolist()
+            except Exception as error:
+                for _X, future in items:
+                    future.set_exception(error)
+                continue
+            self.metrics.record_batch(num_spectra)
+
+            start = 0
+            for X, future in items:
+                future.set_result(labels[start : start + X.shape[0]])
+                start += X.shape[0]
+
+    def close(self):
+        """Stop the batching thread once the queued requests have been handled.
+
+        Requests queued after the batching thread has stopped fail rather than wait.
+        """
+        self._closed = True
+        self._queue.put(None)
+        self._worker.join()
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                item[1].set_exception(RuntimeError("The prediction service is closed."))
+
+
+class PredictionRequestHandler(BaseHTTPRequestHandler):
+    """Handler for the endpoints of the service.
+
+    - `POST /predict?filename=...`: predict the spectra in the request body.
+    - `GET /metrics`: throughput and latency counters.
+    - `GET /health`: whether the service is up, along with the metadata of the model.
+    """
+
+    def _send_json(self, status: int, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        path = urlparse(self.path).path
+        if path == "/metrics":
+            self._send_json(200, service.metrics.to_dict())
+        elif path == "/health":
+            self._send_json(200, {"status": "ok", "metadata": service.metadata})
+        else:
+            self._send_json(404, {"error": f"Unknown endpoint: {path}"})
+
+    def do_POST(self):
+        service = self.server.service
+        url = urlparse(self.path)
+        if url.path != "/predict":
+            self._send_json(404, {"error": f"Unknown endpoint: {url.path}"})
+            return
+
+        filename = parse_qs(url.query).get("filename", [""])[0]
+        buffer = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            predictions = service.predict(buffer, filename)
+        except ValueError as error:
+            self._send_json(400, {"error": str(error)})
+        except Exception as error:
+            self._send_json(500, {"error": repr(error)})
+        else:
+            self._send_json(200, {"predictions": predictions})
+
+    def log_message(self, format, *args):
+        # Keep the per-request logging out of the way of the latency
+        pass
+
+
+def serve(
+    model_filepath: str | Path,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    max_batch_size: int = 256,
+    max_wait_ms: float = 5.0,
+    timeout_s: float = 60.0,
+):
+    """Serve predictions of a saved model over HTTP until interrupted."""
+    service = PredictionService(model_filepath, max_batch_size, max_wait_ms, timeout_s)
+    server = ThreadingHTTPServer((host, port), PredictionRequestHandler)
+    server.service = service
+    print(f"Serving {model_filepath} on http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve predictions of a saved model.")
+    parser.add_argument("model_filepath", type=Path)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=256)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    parser.add_argument("--timeout-s", type=float, default=60.0)
+    args = parser.parse_args()
+    serve(
+        args.model_filepath,
+        args.host,
+        args.port,
+        args.max_batch_size,
+        args.max_wait_ms,
+        args.timeout_s,
+    )
+
+
+if __name__ == "__main__":
+    main()
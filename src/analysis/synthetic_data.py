@@ -0,0 +1,500 @@
+"""
+# Synthetic instrument-format data
+
+This module writes synthetic `chlamy_spectra.tar` archives in the exact on-disk format of each
+instrument, using the same `./chlamy_spectra/...` layout and naming that `load_chlamy_spectra`
+expects. The bundled datasets only contain a few hundred spectra, so these archives are meant for
+load-testing the loaders and classifiers at scale (up to millions of spectra).
+
+## Spectral model
+Each synthetic spectrum is the sum of
+- a fluorescence background, estimated from the bundled CC-124 TAP reference spectrum of the
+  instrument and randomly scaled and tilted per spectrum,
+- Lorentzian peaks at characteristic Raman bands of *Chlamydomonas* cells (carotenoids,
+  chlorophyll, lipids, starch), whose amplitudes depend on strain and medium such that the
+  classes are separable but overlapping,
+- shot-like noise, whose level is estimated from the reference spectrum.
+
+## Usage
+>>> from analysis.synthetic_data import generate_chlamy_archives
+>>> from analysis.load_spectra import load_chlamy_spectra
+>>> summary = generate_chlamy_archives("/tmp/synthetic_data", num_spectra=10_000)
+>>> spectra, dataframe = load_chlamy_spectra(data_directory="/tmp/synthetic_data")
+
+or from the command line
+
+    python -m analysis.synthetic_data /tmp/synthetic_data --n-spectra 10000
+"""
+
+import argparse
+import io
+import tarfile
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from numpy.typing import NDArray
+from scipy.ndimage import maximum_filter1d, minimum_filter1d, uniform_filter1d
+
+from .load_spectra import DATA_DIRECTORY, INSTRUMENT_DIRECTORIES, MEDIA, STRAINS
+
+FloatArray = NDArray[np.float64]
+
+# Bundled CC-124 TAP spectrum of each instrument from which the background and noise are modeled
+REFERENCE_FILEPATHS = {
+    ("horiba", 785): DATA_DIRECTORY / "Horiba_MacroRAM/CC-124-TAP-2.txt",
+    ("openraman", 532): DATA_DIRECTORY / "OpenRAMAN/CC-124_TAP_Pos-2-000_002.csv",
+    ("renishaw", 785): DATA_DIRECTORY / "Renishaw_Qontor/CC-124_TAP_plate_5x_3_points.txt",
+    ("wasatch", 532): DATA_DIRECTORY / "Wasatch_WP532X/CC-124_TAP_Pos-4-002_001.csv",
+    ("wasatch", 785): DATA_DIRECTORY / "Wasatch_WP785X/CC-124_TAP_WP-02071.csv",
+}
+OPENRAMAN_CALIBRATION_FILEPATHS = {
+    "./chlamy_spectra/calibration_data/neon_4x.csv": (
+        DATA_DIRECTORY / "OpenRAMAN/neon_n_n_n_solid_10000_0_5.csv"
+    ),
+    "./chlamy_spectra/calibration_data/acetonitrile_4x.csv": (
+        DATA_DIRECTORY / "OpenRAMAN/acetonitrile_n_n_n_solid_10000_0_5.csv"
+    ),
+}
+
+# Approximate (linear in wavelength) dispersion of the OpenRAMAN spectrometer, estimated from the
+# positions of the 918, 2253 and 2942 cm⁻¹ peaks in the bundled acetonitrile spectrum
+OPENRAMAN_EXCITATION_NM = 532.0
+OPENRAMAN_WAVELENGTH_OFFSET_NM = 543.29
+OPENRAMAN_WAVELENGTH_SLOPE_NM = 0.05505
+
+# Maximum value of the 16-bit detectors of the Wasatch spectrometers
+WASATCH_SATURATION = 65535
+
+# Characteristic Raman bands of Chlamydomonas cells as (center, half width, relative amplitude)
+CHLAMY_RAMAN_BANDS = {
+    "carotenoid": [(1008, 6, 0.35), (1157, 7, 0.8), (1525, 9, 1.0)],
+    "chlorophyll": [(744, 6, 0.1), (1187, 8, 0.15), (1326, 10, 0.15)],
+    "lipid": [(1440, 14, 0.2), (1660, 15, 0.15), (2850, 12, 0.2), (2930, 18, 0.3)],
+    "starch": [(480, 10, 0.1), (940, 12, 0.08)],
+}
+
+# Multiplicative amplitude of each band group per strain and per medium
+STRAIN_BAND_AMPLITUDES = {
+    "CC-124": {"carotenoid": 1.0, "chlorophyll": 1.0, "lipid": 1.0, "starch": 1.0},
+    "CC-125": {"carotenoid": 0.85, "chlorophyll": 1.1, "lipid": 0.9, "starch": 1.2},
+    "CC-1373": {"carotenoid": 1.2, "chlorophyll": 0.9, "lipid": 0.8, "starch": 0.8},
+}
+MEDIUM_BAND_AMPLITUDES = {
+    "TAP": {"carotenoid": 1.0, "chlorophyll": 1.0, "lipid": 1.0, "starch": 1.0},
+    "MN": {"carotenoid": 1.1, "chlorophyll": 0.6, "lipid": 1.8, "starch": 1.5},
+}
+
+
+def openraman_pixels_to_wavenumbers(pixels: FloatArray) -> FloatArray:
+    """Convert OpenRAMAN detector pixels into (approximate) Raman shifts in cm⁻¹."""
+    wavelengths_nm = OPENRAMAN_WAVELENGTH_OFFSET_NM + OPENRAMAN_WAVELENGTH_SLOPE_NM * pixels
+    return 1e7 / OPENRAMAN_EXCITATION_NM - 1e7 / wavelengths_nm
+
+
+def read_reference(instrument: tuple[str, int]) -> dict:
+    """Read the reference spectrum of an instrument along with what is needed to write new files
+    in its format.
+
+    Returns:
+        reference:
+            Dictionary with the wavenumbers and intensities of the reference spectrum, the text
+            preceding the intensity value on each data row (`row_prefixes`), the header lines,
+            and the line endings of the header and the data rows.
+    """
+    filepath = REFERENCE_FILEPATHS[instrument]
+    text = filepath.read_bytes().decode("latin-1")
+    lines = text.splitlines()
+
+    if instrument == ("horiba", 785):
+        header = [line for line in lines if line.startswith("#")]
+        rows = [line.split("\t") for line in lines if line and not line.startswith("#")]
+        axis = [row[0] for row in rows]
+        wavenumbers_cm1 = np.array(axis, dtype=float)
+        intensities = np.array([row[1] for row in rows], dtype=float)
+        row_prefixes = [f"{value}\t" for value in axis]
+
+    elif instrument == ("renishaw", 785):
+        header = lines[:1]
+        data = np.loadtxt(filepath, skiprows=1)
+        wavenumbers_cm1, inverse = np.unique(data[:, 2], return_inverse=True)
+        # Average over the points of the multipoint scan, in descending order like the file
+        counts = np.bincount(inverse)
+        intensities = np.bincount(inverse, weights=data[:, 3]) / counts
+        order = np.argsort(-wavenumbers_cm1)
+        wavenumbers_cm1 = wavenumbers_cm1[order]
+        intensities = intensities[order]
+        row_prefixes = [f"{value:.6f}\t" for value in wavenumbers_cm1]
+
+    elif instrument == ("wasatch", 785):
+        blank_line = lines.index("")
+        header = lines[: blank_line + 2]
+        rows = [line.split(",") for line in lines[blank_line + 2 :] if line]
+        wavenumbers_cm1 = np.array([row[2] for row in rows], dtype=float)
+        # Pixels outside of the region of interest are marked as "NA"
+        intensities = np.array([np.nan if row[3] == "NA" else row[3] for row in rows], dtype=float)
+        row_prefixes = [f"{','.join(row[:3])}," for row in rows]
+
+    else:
+        header = lines[:1]
+        rows = [line.split(",") for line in lines[1:] if line]
+        axis = [row[0] for row in rows]
+        intensities = np.array([row[1] for row in rows], dtype=float)
+        if instrument == ("openraman", 532):
+            wavenumbers_cm1 = openraman_pixels_to_wavenumbers(np.array(axis, dtype=float))
+        else:
+            wavenumbers_cm1 = np.array(axis, dtype=float)
+        row_prefixes = [f"{value}," for value in axis]
+
+    return {
+        "wavenumbers_cm1": wavenumbers_cm1,
+        "intensities": intensities,
+        "row_prefixes": row_prefixes,
+        "header": header,
+        "header_newline": "\r\n" if lines[0] + "\r\n" in text else "\n",
+        "newline": "\r\n" if text.endswith("\r\n") else "\n",
+    }
+
+
+def estimate_background(intensities: FloatArray, window_size: int = 101) -> FloatArray:
+    """Estimate the fluorescence background of a spectrum by a morphological opening (which
+    removes peaks narrower than the window) followed by a moving average."""
+    finite = np.isfinite(intensities)
+    # Fill in missing values (e.g. outside of the region of interest) from their neighbors
+    indices = np.arange(intensities.size)
+    y = np.interp(indices, indices[finite], intensities[finite])
+    opened = maximum_filter1d(minimum_filter1d(y, window_size), window_size)
+    return uniform_filter1d(opened, window_size)
+
+
+def get_spectral_model(reference: dict) -> dict:
+    """Derive the background, peak scale, and noise level of the spectral model from a reference
+    spectrum."""
+    wavenumbers_cm1 = reference["wavenumbers_cm1"]
+    intensities = reference["intensities"]
+    background = estimate_background(intensities)
+
+    # Robust estimate of the noise from the point-to-point differences
+    residuals = (intensities - background)[np.isfinite(intensities)]
+    differences = np.diff(residuals)
+    noise_sigma = 1.4826 * np.median(np.abs(differences - np.median(differences))) / np.sqrt(2)
+    noise_sigma = max(noise_sigma, 1e-3 * np.abs(background).mean())
+    peak_scale = max(np.percentile(residuals, 99.5), 10 * noise_sigma)
+
+    return {
+        "wavenumbers_cm1": wavenumbers_cm1,
+        "background": np.clip(background, 0, None),
+        "peak_scale": peak_scale,
+        "noise_sigma": noise_sigma,
+    }
+
+
+def simulate_spectra(
+    model: dict,
+    strain: str,
+    medium: str,
+    num_spectra: int,
+    rng: np.random.Generator,
+) -> FloatArray:
+    """Simulate the intensities of cell spectra of a given strain and medium.
+
+    Args:
+        model:
+            Spectral model of the instrument as returned by `get_spectral_model`.
+        strain:
+            Strain of the cells, e.g. "CC-124".
+        medium:
+            Medium in which the cells were grown, either "MN" or "TAP".
+        num_spectra:
+            Number of spectra to simulate.
+        rng:
+            Random number generator.
+
+    Returns:
+        intensities:
+            Array of shape (num_spectra, num_wavenumbers).
+    """
+    wavenumbers_cm1 = model["wavenumbers_cm1"]
+    background = model["background"]
+
+    # Fluorescence background: scaled and tilted version of the reference background
+    x = np.interp(wavenumbers_cm1, [wavenumbers_cm1.min(), wavenumbers_cm1.max()], [-1, 1])
+    scales = rng.lognormal(0, 0.2, size=(num_spectra, 1))
+    tilts = rng.normal(0, 0.05, size=(num_spectra, 1))
+    fluorescence = background * scales * (1 + tilts * x)
+
+    # Raman peaks
+    peaks = np.zeros((num_spectra, wavenumbers_cm1.size))
+    for group, bands in CHLAMY_RAMAN_BANDS.items():
+        group_amplitude = (
+            STRAIN_BAND_AMPLITUDES[strain][group] * MEDIUM_BAND_AMPLITUDES[medium][group]
+        )
+        group_amplitudes = group_amplitude * rng.lognormal(0, 0.15, size=(num_spectra, 1))
+        for center, half_width, amplitude in bands:
+            shifts = rng.normal(0, 1, size=(num_spectra, 1))
+            lorentzian = 1 / (1 + ((wavenumbers_cm1 - center - shifts) / half_width) ** 2)
+            peaks += amplitude * group_amplitudes * lorentzian
+    signal = fluorescence + model["peak_scale"] * peaks
+
+    # Shot-like noise, scaled to the noise level of the reference
+    relative_signal = np.clip(signal, 0, None) / max(background.mean(), 1e-12)
+    noise = (
+        model["noise_sigma"] * np.sqrt(relative_signal + 0.1) * rng.standard_normal(signal.shape)
+    )
+    return signal + noise
+
+
+def _get_row_template(row_prefixes: list[str], value_format: str, newline: str) -> str:
+    """Template for formatting the intensities of a spectrum into data rows in one go."""
+    return "".join(f"{prefix.replace('%', '%%')}{value_format}{newline}" for prefix in row_prefixes)
+
+
+def _add_member(tar: tarfile.TarFile, name: str, data: bytes, mtime: float):
+    """Add an in-memory file to a tar file."""
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.size = len(data)
+    tarinfo.mtime = mtime
+    tarinfo.mode = 0o644
+    tar.addfile(tarinfo, io.BytesIO(data))
+
+
+def _format_horiba(reference: dict, intensities: FloatArray, title: str, time: datetime) -> bytes:
+    replacements = {
+        "#Title=": title,
+        "#Date=": time.strftime("%d.%m.%Y %H:%M"),
+        "#Acquired=": time.strftime("%d.%m.%Y %H:%M:%S"),
+    }
+    header = []
+    for line in reference["header"]:
+        key = line.split("\t")[0]
+        header.append(f"{key}\t{replacements[key]}" if key in replacements else line)
+    rows = reference["template"] % tuple(np.round(intensities, 1))
+    newline = reference["header_newline"]
+    return (newline.join(header) + newline + rows).encode("latin-1")
+
+
+def _format_renishaw(
+    reference: dict,
+    intensities: FloatArray,
+    positions: FloatArray,
+) -> bytes:
+    lines = [reference["header"][0] + reference["newline"]]
+    for (x, y), point_intensities in zip(positions, intensities, strict=True):
+        position = f"{x:.6f}\t{y:.6f}\t"
+        row_prefixes = [position + prefix for prefix in reference["row_prefixes"]]
+        template = _get_row_template(row_prefixes, "%.6f", reference["newline"])
+        lines.append(template % tuple(point_intensities))
+    return "".join(lines).encode()
+
+
+def _format_wasatch_enlighten(
+    reference: dict,
+    intensities: FloatArray,
+    label: str,
+    measurement_id: str,
+    time: datetime,
+) -> bytes:
+    replacements = {
+        "Measurement ID": measurement_id,
+        "Label": label,
+        "Timestamp": time.strftime("%Y-%m-%d %H:%M:%S.%f"),
+    }
+    header = []
+    for line in reference["header"]:
+        key = line.split(",")[0]
+        header.append(f"{key},{replacements[key]}" if key in replacements else line)
+    values = np.where(reference["mask"], np.round(intensities, 2), np.nan)
+    rows = reference["template"] % tuple(values)
+    # Pixels outside of the region of interest are not processed
+    rows = rows.replace(",nan\r", ",NA\r").replace(",nan\n", ",NA\n")
+    newline = reference["header_newline"]
+    return (newline.join(header) + newline + rows).encode()
+
+
+def _format_pixel_csv(reference: dict, intensities: FloatArray) -> bytes:
+    header = reference["header"][0] + reference["header_newline"]
+    return (header + reference["template"] % tuple(intensities)).encode()
+
+
+def write_chlamy_archive(
+    tarpath: str | Path,
+    instrument: tuple[str, int],
+    num_spectra: int,
+    points_per_file: int = 10,
+    chunk_size: int = 1024,
+    seed: int = 0,
+) -> int:
+    """Write a synthetic `chlamy_spectra.tar` archive in the format of an instrument.
+
+    The spectra are distributed evenly over each (strain, medium) combination and generated in
+    chunks, such that memory use is independent of the total number of spectra.
+
+    Args:
+        tarpath:
+            Path of the tar file to write.
+        instrument:
+            (instrument, wavelength) combination, e.g. ("wasatch", 785).
+        num_spectra:
+            Total number of spectra to write.
+        points_per_file:
+            Number of points per multipoint scan (Renishaw only). Other instruments store one
+            spectrum per file.
+        chunk_size:
+            Number of spectra to simulate at once.
+        seed:
+            Seed of the random number generator.
+
+    Returns:
+        num_files:
+            Number of spectrum files written to the archive (excluding calibration files).
+    """
+    rng = np.random.default_rng(seed)
+    reference = read_reference(instrument)
+    model = get_spectral_model(reference)
+    value_formats = {
+        ("horiba", 785): "%.6g",
+        ("openraman", 532): "%.12g",
+        ("wasatch", 532): "%.1f",
+        ("wasatch", 785): "%.2f",
+    }
+    if instrument in value_formats:
+        reference["template"] = _get_row_template(
+            reference["row_prefixes"], value_formats[instrument], reference["newline"]
+        )
+    if instrument == ("wasatch", 785):
+        reference["mask"] = np.isfinite(reference["intensities"])
+
+    spectra_per_file = points_per_file if instrument == ("renishaw", 785) else 1
+    chunk_size = max(chunk_size // spectra_per_file, 1) * spectra_per_file
+    groups = [(strain, medium) for strain in STRAINS for medium in MEDIA]
+    group_sizes = np.diff(np.linspace(0, num_spectra, len(groups) + 1).round().astype(int))
+    start_time = datetime(2024, 11, 12, 9, 0, 0)
+
+    num_files = 0
+    Path(tarpath).parent.mkdir(parents=True, exist_ok=True)
+    with tarfile.open(tarpath, "w") as tar:
+        if instrument == ("openraman", 532):
+            for name, filepath in OPENRAMAN_CALIBRATION_FILEPATHS.items():
+                _add_member(tar, name, filepath.read_bytes(), start_time.timestamp())
+
+        for (strain, medium), group_size in zip(groups, group_sizes, strict=True):
+            for chunk_start in range(0, group_size, chunk_size):
+                num_chunk = min(chunk_size, group_size - chunk_start)
+                intensities = simulate_spectra(model, strain, medium, num_chunk, rng)
+                if instrument[0] == "wasatch":
+                    intensities = np.clip(intensities, None, WASATCH_SATURATION)
+
+                for file_start in range(0, num_chunk, spectra_per_file):
+                    file_intensities = intensities[file_start : file_start + spectra_per_file]
+                    index = (chunk_start + file_start) // spectra_per_file
+                    time = start_time + timedelta(seconds=7 * num_files)
+                    sample = f"{strain}_{medium}"
+
+                    if instrument == ("horiba", 785):
+                        name = f"./chlamy_spectra/{strain}-{medium}-{index + 1}.txt"
+                        title = f"{strain}-{medium}-{index + 1}"
+                        data = _format_horiba(reference, file_intensities[0], title, time)
+                    elif instrument == ("renishaw", 785):
+                        name = f"./chlamy_spectra/2024-11-12_{sample}_slide_{index}_cells.txt"
+                        positions = rng.uniform(-1000, 1000, size=(len(file_intensities), 2))
+                        data = _format_renishaw(reference, file_intensities, positions)
+                    elif instrument == ("wasatch", 785):
+                        stamp = time.strftime("%Y%m%d-%H%M%S-%f")
+                        measurement_id = f"{stamp}-WP-02071"
+                        label = f"enlighten-{sample}_{measurement_id}"
+                        name = f"./chlamy_spectra/{label}.csv"
+                        data = _format_wasatch_enlighten(
+                            reference, file_intensities[0], label, measurement_id, time
+                        )
+                    else:
+                        name = (
+                            f"./chlamy_spectra/{sample}/Pos-{index // 1000}-{index % 1000:03d}.csv"
+                        )
+                        data = _format_pixel_csv(reference, file_intensities[0])
+
+                    _add_member(tar, name, data, time.timestamp())
+                    num_files += 1
+
+                # The archive is only written to, so there is no need to keep every member's
+                # header in memory, which adds up when writing millions of files
+                tar.members.clear()
+
+    return num_files
+
+
+def generate_chlamy_archives(
+    output_directory: str | Path,
+    num_spectra: int | dict[tuple[str, int], int] = 1000,
+    instruments: list[tuple[str, int]] | None = None,
+    points_per_file: int = 10,
+    chunk_size: int = 1024,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """Write synthetic `chlamy_spectra.tar` archives for each instrument.
+
+    The archives are written to `<output_directory>/<instrument directory>/chlamy_spectra.tar`,
+    mirroring the layout of the data directory, such that `output_directory` can be passed to
+    `load_chlamy_spectra` directly.
+
+    Args:
+        output_directory:
+            Directory in which to write the archives.
+        num_spectra:
+            Number of spectra per instrument, or a dictionary mapping each instrument to a number.
+        instruments:
+            (instrument, wavelength) combinations for which to write archives. Defaults to all.
+        points_per_file:
+            Number of points per multipoint scan (Renishaw only).
+        chunk_size:
+            Number of spectra to simulate at once.
+        seed:
+            Seed of the random number generators.
+
+    Returns:
+        summary:
+            DataFrame with the path, number of files, and number of spectra of each archive.
+    """
+    if instruments is None:
+        instruments = list(INSTRUMENT_DIRECTORIES.keys())
+    if isinstance(num_spectra, int):
+        num_spectra = {instrument: num_spectra for instrument in instruments}
+
+    records = []
+    for i, instrument in enumerate(instruments):
+        tarpath = Path(output_directory) / INSTRUMENT_DIRECTORIES[instrument] / "chlamy_spectra.tar"
+        num_files = write_chlamy_archive(
+            tarpath,
+            instrument,
+            num_spectra[instrument],
+            points_per_file=points_per_file,
+            chunk_size=chunk_size,
+            seed=seed + i,
+        )
+        records.append((*instrument, tarpath, num_files, num_spectra[instrument]))
+
+    columns = ["instrument", "λ_nm", "tarpath", "num_files", "num_spectra"]
+    return pd.DataFrame.from_records(records, columns=columns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic chlamy_spectra.tar archives.")
+    parser.add_argument("output_directory", type=Path)
+    parser.add_argument("--n-spectra", type=int, default=1000, help="Spectra per instrument.")
+    parser.add_argument("--points-per-file", type=int, default=10)
+    parser.add_argument("--chunk-size", type=int, default=1024)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    summary = generate_chlamy_archives(
+        args.output_directory,
+        num_spectra=args.n_spectra,
+        points_per_file=args.points_per_file,
+        chunk_size=args.chunk_size,
+        seed=args.seed,
+    )
+    print(summary.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()